@@ -0,0 +1,61 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from newsletter.delivery import DeliveryEngine, QueueDrainer
+
+
+class Command(BaseCommand):
+    help = 'Runs continuously sending queued messages, many instances can run in parallel.' # noqa
+
+    def add_arguments(self, parser):
+
+        # Named (optional) arguments
+        parser.add_argument(
+            '--connections',
+            action='store',
+            type=int,
+            dest='connections',
+            help='Number of smtp connections used in parallel',
+        )
+        parser.add_argument(
+            '--batch-size',
+            action='store',
+            type=int,
+            dest='batch_size',
+            help='Initial number of messages claimed at a time',
+        )
+        parser.add_argument(
+            '--rate',
+            action='store',
+            type=float,
+            dest='rate',
+            help='Initial messages per second',
+        )
+        parser.add_argument(
+            '--max-rate',
+            action='store',
+            type=float,
+            dest='max_rate',
+            help='Maximum messages per second',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            dest='once',
+            help='Exit when the queue is empty',
+        )
+
+    def handle(self, *args, **options):
+        engine = DeliveryEngine(connections=options['connections'])
+        drainer = QueueDrainer(
+            engine,
+            batch_size=options['batch_size'],
+            rate=options['rate'],
+            max_rate=options['max_rate'])
+        signal.signal(signal.SIGTERM, drainer.stop)
+        signal.signal(signal.SIGINT, drainer.stop)
+        try:
+            drainer.run(once=options['once'])
+        finally:
+            engine.close()
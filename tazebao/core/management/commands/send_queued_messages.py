@@ -1,6 +1,6 @@
 from django.core.management.base import BaseCommand
 
-from mailqueue.models import MailerMessage
+from newsletter.delivery import DeliveryEngine
 
 
 class Command(BaseCommand):
@@ -15,6 +15,17 @@ class Command(BaseCommand):
             dest='limit',
             help='Limit the number of emails to process',
         )
+        parser.add_argument(
+            '--connections',
+            action='store',
+            type=int,
+            dest='connections',
+            help='Number of smtp connections used in parallel',
+        )
 
     def handle(self, *args, **options):
-        MailerMessage.objects.send_queued(limit=options['limit'])
+        engine = DeliveryEngine(connections=options['connections'])
+        try:
+            engine.send_queued(limit=options['limit'])
+        finally:
+            engine.close()
@@ -46,6 +46,61 @@ EMAIL_HOST = "localhost"
 EMAIL_PORT = 25
 
 TEST_EMAIL_MAX_NUM = 50
+# number of queued messages written with a single insert when dispatching
+NEWSLETTER_ENQUEUE_BATCH_SIZE = 500
+# bigger dispatches are split in shards rendered by parallel celery tasks
+NEWSLETTER_DISPATCH_SHARD_SIZE = 5000
+# seconds a worker owns a shard without checkpointing, times a failing
+# shard is retried before the dispatch is closed with an error, and seconds
+# between retries (multiplied by the attempts)
+NEWSLETTER_SHARD_LEASE = 300
+NEWSLETTER_SHARD_MAX_ATTEMPTS = 3
+NEWSLETTER_SHARD_RETRY_DELAY = 60
+# subscribers read per query when iterating the dispatch recipients
+NEWSLETTER_RECIPIENTS_CHUNK_SIZE = 2000
+# persistent smtp connections used in parallel to send the queued messages
+NEWSLETTER_SMTP_CONNECTIONS = 4
+# queued messages loaded and marked as sent per query
+NEWSLETTER_DELIVERY_BATCH_SIZE = 200
+# drain_mail_queue adaptive control: initial and max batch size and rate
+# (messages per second), per message smtp latency (seconds) to stay under
+NEWSLETTER_DRAINER_BATCH_SIZE = 50
+NEWSLETTER_DRAINER_MAX_BATCH_SIZE = 1000
+NEWSLETTER_DRAINER_RATE = 50
+NEWSLETTER_DRAINER_MAX_RATE = 1000
+NEWSLETTER_DRAINER_TARGET_LATENCY = 0.5
+# seconds before the drainer retries a failed message
+NEWSLETTER_DRAINER_RETRY_DELAY = 300
+# per recipient domain throttling: (messages per second, burst), domains not
+# listed use NEWSLETTER_DEFAULT_DOMAIN_RATE (None means no limit)
+NEWSLETTER_DOMAIN_RATES = {
+    'gmail.com': (20, 100),
+    'googlemail.com': (20, 100),
+}
+NEWSLETTER_DEFAULT_DOMAIN_RATE = None
+# open and click events are buffered ('redis' list or 'local' memory) and
+# stored in batches by the ingest_tracking_events command
+NEWSLETTER_TRACKING_BUFFER = 'redis'
+NEWSLETTER_TRACKING_BATCH_SIZE = 1000
+# seconds the per client counts used to decide the api pagination are cached
+NEWSLETTER_COUNT_CACHE_TIMEOUT = 300
+# seconds the dashboard stats api payload is cached per client
+NEWSLETTER_STATS_CACHE_TIMEOUT = 60
+# days of dispatches charted in the admin dashboard, seconds it is cached
+NEWSLETTER_DASHBOARD_DAYS = 365
+NEWSLETTER_DASHBOARD_CACHE_TIMEOUT = 300
+# seconds a campaign texts render is cached (per last edit datetime)
+NEWSLETTER_PREVIEW_CACHE_TIMEOUT = 86400
+# compiled campaign and unsubscribe url templates kept per process
+NEWSLETTER_TEMPLATE_CACHE_SIZE = 64
+# csv rows validated and written together when importing subscribers
+NEWSLETTER_IMPORT_CHUNK_SIZE = 1000
+# uploaded csv files waiting to be imported, outside the public media root
+NEWSLETTER_IMPORTS_ROOT = os.path.join(BASE_DIR, "imports")
+# subscribers deleted per transaction by the api bulk deletions, selections
+# larger than NEWSLETTER_DELETE_SYNC_LIMIT are deleted by celery tasks
+NEWSLETTER_DELETE_CHUNK_SIZE = 1000
+NEWSLETTER_DELETE_SYNC_LIMIT = 1000
 
 # Database
 # https://docs.djangoproject.com/en/1.8/ref/settings/#databases
@@ -449,7 +504,9 @@ CORS_ALLOW_HEADERS = (
     "content-type",
     "authorization",
     "set-cookie",
+    "if-none-match",
 )
+CORS_EXPOSE_HEADERS = ("etag",)
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
         "rest_framework_jwt.authentication.JSONWebTokenAuthentication",
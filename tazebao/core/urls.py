@@ -25,7 +25,7 @@ from rest_framework_jwt.views import obtain_jwt_token, refresh_jwt_token
 from core.views.api import WhoAmI
 from newsletter.views import (CampaignViewSet, DispatchStatsApiView, DispatchViewSet,
                               FailedEmailApiView, FailedEmailViewSet,
-                              ImportSubscribersFromCsv, MailerMessageViewSet,
+                              ImportJobViewSet, ImportSubscribersFromCsv, MailerMessageViewSet,
                               PlanningViewSet, StatsApiView, SubjectSuggestionApiView,
                               SubscriberListViewSet, SubscriberViewSet, SubscriptionFormViewSet, SubscriptionsStatsApiView, SystemMessageViewSet,
                               TopicViewSet)
@@ -42,6 +42,7 @@ router.register(r'newsletter/bounces', FailedEmailViewSet)
 router.register(r'newsletter/mailermessage', MailerMessageViewSet)
 router.register(r'newsletter/subscriptionform', SubscriptionFormViewSet)
 router.register(r'newsletter/systemmessages', SystemMessageViewSet)
+router.register(r'newsletter/importjob', ImportJobViewSet)
 # END API
 
 urlpatterns = [
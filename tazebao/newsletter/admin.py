@@ -1,13 +1,15 @@
 from django import forms
 from django.conf import settings
 from django.contrib import admin
+from django.db.models import Count
 from django.http.response import HttpResponseRedirect
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
 from django.utils.crypto import get_random_string
 from django.utils.safestring import mark_safe
 
-from .models import (Campaign, Client, Dispatch, FailedEmail, Planning,
+from .models import (Campaign, Client, Dispatch, FailedEmail,
+                     MailerMessageDispatch, Planning,
                      Subscriber, SubscriberList, SuggestionRequest, SystemMessage, SystemMessageRead, Topic, Tracking,
                      Unsubscription, UserMailerMessage, SubscriptionForm)
 # send campaign
@@ -128,10 +130,16 @@ class SubscriberListAdmin(DisplayOnlyIfAdminOrHasClient, ManageOnlyClientsRows,
     )
     list_filter = (('client', admin.RelatedOnlyFieldListFilter), )
 
+    def get_queryset(self, request):
+        """ Counts the subscribers of all the lists in one query """
+        qs = super(SubscriberListAdmin, self).get_queryset(request)
+        return qs.annotate(tot_subscribers=Count('subscriber'))
+
     def subscribers(self, obj):
-        return obj.subscriber_set.all().count()
+        return obj.tot_subscribers
 
     subscribers.short_description = 'numero iscritti'
+    subscribers.admin_order_field = 'tot_subscribers'
 
 
 admin.site.register(SubscriberList, SubscriberListAdmin)
@@ -550,7 +558,8 @@ class DispatchAdmin(DisplayOnlyIfAdminOrHasClient):
 
     def get_queryset(self, request):
         """ Let no admin user see only related dispatches """
-        qs = super(DispatchAdmin, self).get_queryset(request)
+        qs = super(DispatchAdmin, self).get_queryset(request).select_related(
+            'campaign', 'stats')
         if request.user.is_superuser:
             return qs
         return qs.filter(campaign__client__user=request.user)
@@ -560,8 +569,7 @@ class DispatchAdmin(DisplayOnlyIfAdminOrHasClient):
             return ''
         elif not obj.open_statistics:
             return 'N.D.'
-        trackings = Tracking.objects.filter(
-            dispatch=obj, type=Tracking.OPEN_TYPE).count()  # noqa
+        trackings = obj.get_stats().unique_opens
         perc = round(100 * trackings / float(obj.sent), 1)
         return mark_safe(
             '<span style="font-weight: bold;color: %s">%s%%</span> (%s/%s)' %
@@ -575,11 +583,9 @@ class DispatchAdmin(DisplayOnlyIfAdminOrHasClient):
             return ''
         elif not obj.click_statistics:
             return 'N.D.'
-        clicks = Tracking.objects.filter(
-            dispatch=obj, type=Tracking.CLICK_TYPE).count()  # noqa
-        clicks_s = Tracking.objects.filter(
-            dispatch=obj, type=Tracking.CLICK_TYPE).values(
-                'subscriber').distinct().count()  # noqa
+        stats = obj.get_stats()
+        clicks = stats.total_clicks
+        clicks_s = stats.unique_clickers
 
         perc = round(100 * clicks_s / float(obj.sent), 1)
 
@@ -713,7 +719,10 @@ class UserMailerMessageAdmin(admin.ModelAdmin):
     it_last_attempt.short_description = 'Ultimo tentativo'
 
     def dispatch(self, obj):
-        return '%s' % (Dispatch.objects.get(pk=int(obj.app)))
+        try:
+            return '%s' % obj.dispatch_link.dispatch
+        except MailerMessageDispatch.DoesNotExist:
+            return '-'
 
     dispatch.short_description = 'App: Invio ID - DATA CAMPAGNA'
 
@@ -724,13 +733,11 @@ class UserMailerMessageAdmin(admin.ModelAdmin):
     def get_queryset(self, request):
         """ Let the user see only related logs
         """
-        qs = super(UserMailerMessageAdmin, self).get_queryset(request)
+        qs = super(UserMailerMessageAdmin, self).get_queryset(
+            request).select_related('dispatch_link__dispatch__campaign')
         if request.user.is_superuser:
             return qs
-        return qs.filter(app__in=[
-            str(d.pk) for d in Dispatch.objects.filter(
-                campaign__client__user=request.user)
-        ])
+        return qs.filter(dispatch_link__client__user=request.user)
 
     def send_failed(self, request, queryset):
         emails = queryset.filter(sent=False)
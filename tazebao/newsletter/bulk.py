@@ -0,0 +1,139 @@
+from collections import Counter
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
+
+from .caching import invalidate_client_counts
+from .models import (DailyStats, FailedEmail, Subscriber, Tracking,
+                     Unsubscription, local_date)
+
+INSERT_IGNORE = {
+    'mysql': ('INSERT IGNORE INTO', ''),
+    'sqlite': ('INSERT OR IGNORE INTO', ''),
+    'postgresql': ('INSERT INTO', ' ON CONFLICT DO NOTHING'),
+}
+
+
+def _subscribers_sql(subscribers):
+    """ SQL selecting the ids of the subscribers queryset, wrapped in a
+        derived table so that MySQL accepts it when the statement target is
+        a table it reads from
+    """
+    sql, params = subscribers.order_by().values('id').query.sql_with_params()
+    return 'SELECT id FROM (%s) AS subscribers_ids' % sql, params
+
+
+def add_to_lists(subscribers, lists_ids):
+    """ Adds the subscribers of the queryset to the given lists with one
+        INSERT ... SELECT per list, existing memberships are ignored
+    """
+    through = Subscriber.lists.through
+    connection = connections[subscribers.db]
+    insert, conflict = INSERT_IGNORE[connection.vendor]
+    select_sql, select_params = _subscribers_sql(subscribers)
+    sql = '%s %s (%s, %s) SELECT id, %%s FROM (%s) AS s%s' % (
+        insert,
+        connection.ops.quote_name(through._meta.db_table),
+        connection.ops.quote_name('subscriber_id'),
+        connection.ops.quote_name('subscriberlist_id'),
+        select_sql,
+        conflict,
+    )
+    with connection.cursor() as cursor:
+        for list_id in lists_ids:
+            cursor.execute(sql, [int(list_id)] + list(select_params))
+
+
+def remove_from_lists(subscribers, lists_ids):
+    """ Removes the subscribers of the queryset from the given lists with a
+        single DELETE
+    """
+    through = Subscriber.lists.through
+    connection = connections[subscribers.db]
+    select_sql, select_params = _subscribers_sql(subscribers)
+    lists_ids = [int(x) for x in lists_ids]
+    if not lists_ids:
+        return
+    sql = 'DELETE FROM %s WHERE %s IN (%s) AND %s IN (%s)' % (
+        connection.ops.quote_name(through._meta.db_table),
+        connection.ops.quote_name('subscriberlist_id'),
+        ', '.join(['%s'] * len(lists_ids)),
+        connection.ops.quote_name('subscriber_id'),
+        select_sql,
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, lists_ids + list(select_params))
+
+
+def _delete_rows(model, column, ids):
+    """ Deletes the rows of model whose column is in ids with a single
+        DELETE, no signal is sent and no cascade is collected
+    """
+    connection = connections[model.objects.db]
+    sql = 'DELETE FROM %s WHERE %s IN (%s)' % (
+        connection.ops.quote_name(model._meta.db_table),
+        connection.ops.quote_name(column),
+        ', '.join(['%s'] * len(ids)),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, list(ids))
+
+
+def delete_chunks(ids, chunk_size=None):
+    """ Splits the ids of the subscribers to delete in chunks """
+    chunk_size = chunk_size or getattr(settings,
+                                       'NEWSLETTER_DELETE_CHUNK_SIZE', 1000)
+    ids = list(ids)
+    return [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+
+
+def delete_subscribers(ids, chunk_size=None):
+    """ Deletes the subscribers with the given ids, returns their number
+
+        Subscribers are deleted chunk_size at a time with set based
+        statements: the unsubscriptions log rows are written with one bulk
+        insert, trackings, bounces and lists memberships with one DELETE
+        each, so no per row signal or cascade collection is involved. The
+        daily stats are updated per day.
+    """
+    deleted = 0
+    clients_ids = set()
+    for chunk in delete_chunks(ids, chunk_size):
+        with transaction.atomic():
+            rows = list(
+                Subscriber.objects.select_for_update().filter(
+                    id__in=chunk).values_list('id', 'client_id',
+                                              'subscription_datetime'))
+            if not rows:
+                continue
+            chunk = [x[0] for x in rows]
+            # (client id, date): removed subscriptions and bounces
+            removed = {}
+            for subscriber_id, client_id, subscription_datetime in rows:
+                key = (client_id, local_date(subscription_datetime))
+                removed.setdefault(key, Counter())['subscriptions'] -= 1
+            for client_id, bounce_datetime in FailedEmail.objects.filter(
+                    subscriber_id__in=chunk).values_list('client_id',
+                                                         'datetime'):
+                key = (client_id, local_date(bounce_datetime))
+                removed.setdefault(key, Counter())['bounces'] -= 1
+            Unsubscription.objects.bulk_create(
+                [Unsubscription(client_id=x[1]) for x in rows])
+            for model, column in (
+                (Tracking, 'subscriber_id'),
+                (FailedEmail, 'subscriber_id'),
+                (Subscriber.lists.through, 'subscriber_id'),
+                (Subscriber, 'id'),
+            ):
+                _delete_rows(model, column, chunk)
+            for (client_id, day), counters in removed.items():
+                DailyStats.increment(client_id, day, **counters)
+            today = timezone.localdate()
+            for client_id, count in Counter([x[1] for x in rows]).items():
+                DailyStats.increment(client_id, today, unsubscriptions=count)
+        deleted += len(rows)
+        clients_ids.update([x[1] for x in rows])
+    for client_id in clients_ids:
+        invalidate_client_counts(client_id, Subscriber, FailedEmail)
+    return deleted
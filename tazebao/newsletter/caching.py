@@ -0,0 +1,70 @@
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+
+COUNT_KEY = 'newsletter:count:%s:%s'
+STATS_KEY = 'newsletter:stats:%s'
+
+# client id: user id, a client user never changes
+_client_users = {}
+
+
+def _timeout():
+    return getattr(settings, 'NEWSLETTER_COUNT_CACHE_TIMEOUT', 300)
+
+
+def client_count(queryset, user_id):
+    """ Returns the count of a client queryset (not filtered by request
+        params), cached per model and user
+
+        The cache is invalidated when the model rows of the client change,
+        the timeout covers the writes which send no signals.
+    """
+    key = COUNT_KEY % (queryset.model._meta.label_lower, user_id)
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, _timeout())
+    return count
+
+
+def _client_user(client_id):
+    from .models import Client
+    if client_id not in _client_users:
+        _client_users[client_id] = Client.objects.filter(
+            pk=client_id).values_list('user_id', flat=True).first()
+    return _client_users[client_id]
+
+
+def invalidate_client_counts(client_id, *models):
+    """ Drops the cached counts of the given models and the stats of a
+        client
+    """
+    user_id = _client_user(client_id)
+    if user_id is not None:
+        cache.delete_many(
+            [COUNT_KEY % (x._meta.label_lower, user_id) for x in models] +
+            [STATS_KEY % user_id])
+
+
+def client_stats(user_id, compute):
+    """ Returns the (etag, stats) of a client user, cached for a short time
+
+        compute is called on cache misses and returns the stats, a json
+        serializable dict. The cache is invalidated together with the client
+        counts.
+    """
+    key = STATS_KEY % user_id
+    value = cache.get(key)
+    if value is None:
+        stats = compute()
+        etag = '"%s"' % hashlib.md5(
+            json.dumps(stats, sort_keys=True,
+                       cls=DjangoJSONEncoder).encode('utf-8')).hexdigest()
+        value = (etag, stats)
+        cache.set(key, value,
+                  getattr(settings, 'NEWSLETTER_STATS_CACHE_TIMEOUT', 60))
+    return value
@@ -0,0 +1,79 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from django.utils import timezone
+
+from .models import Dispatch, FailedEmail, Subscriber, SubscriberList, Tracking
+
+DASHBOARD_KEY = 'newsletter:dashboard:%s'
+# dispatches sent to fewer addresses are considered tests
+DASHBOARD_THRESHOLD = 20
+
+
+def admin_dashboard(client):
+    """ Data of the admin dashboard of a client, cached per client
+
+        Only the dispatches of the last NEWSLETTER_DASHBOARD_DAYS days are
+        charted, their opens and clicks are counted with one grouped query
+        per type. Lists and bounces are plain dicts exposing the count
+        attribute the dashboard template reads.
+    """
+    key = DASHBOARD_KEY % client.pk
+    data = cache.get(key)
+    if data is None:
+        data = _admin_dashboard(client)
+        cache.set(
+            key, data,
+            getattr(settings, 'NEWSLETTER_DASHBOARD_CACHE_TIMEOUT', 300))
+    return data
+
+
+def _admin_dashboard(client):
+    since = timezone.now() - timedelta(
+        days=getattr(settings, 'NEWSLETTER_DASHBOARD_DAYS', 365))
+    dispatches = list(
+        Dispatch.objects.filter(
+            campaign__client=client,
+            error=False,
+            sent__gt=DASHBOARD_THRESHOLD,
+            started_at__gte=since).select_related(
+                'campaign', 'stats').order_by('-started_at'))
+    # type: dispatch id: trackings
+    trackings = {Tracking.OPEN_TYPE: {}, Tracking.CLICK_TYPE: {}}
+    for type in trackings.keys():
+        trackings[type] = dict(
+            Tracking.objects.filter(
+                dispatch__in=[x.pk for x in dispatches],
+                type=type).order_by().values_list('dispatch').annotate(
+                    num=Count('id')))
+    series = dict([(
+        type,
+        [{
+            'name': x.campaign.name,
+            'dt': x.started_at,
+            'num': counts.get(x.pk, 0),
+        } for x in dispatches],
+    ) for type, counts in trackings.items()])
+    lists = [{
+        'name': name,
+        'subscriber_set': {
+            'count': count
+        },
+    } for name, count in SubscriberList.objects.filter(
+        client=client).annotate(count=Count('subscriber')).values_list(
+            'name', 'count')]
+    return {
+        'last_dispatches': dispatches[:4],
+        'subscribers_bounces': {
+            'count':
+            FailedEmail.objects.filter(client=client).values(
+                'subscriber').distinct().count(),
+        },
+        'lists': lists,
+        'tot_subscribers': Subscriber.objects.filter(client=client).count(),
+        'opening_data': series[Tracking.OPEN_TYPE],
+        'click_data': series[Tracking.CLICK_TYPE],
+        'threshold': DASHBOARD_THRESHOLD,
+    }
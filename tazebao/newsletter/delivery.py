@@ -0,0 +1,426 @@
+import logging
+import os
+import smtplib
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.db.models import Q, prefetch_related_objects
+from django.utils import timezone
+
+from mailqueue import defaults as mailqueue_defaults
+from mailqueue.models import MailerMessage
+
+from .models import Dispatch
+
+logger = logging.getLogger(__name__)
+
+SENT = 'sent'
+FAILED = 'failed'
+# temporary (4xx) refusal, usually a rate limit of the recipient domain
+DEFERRED = 'deferred'
+
+
+def _addresses(value):
+    return [x.strip() for x in (value or '').split(',') if x.strip()]
+
+
+def build_email(message):
+    """ Builds the EmailMultiAlternatives of a queued message, as mailqueue
+        does when sending it
+    """
+    msg = EmailMultiAlternatives(message.subject, message.content,
+                                 message.from_address)
+    if message.reply_to:
+        msg.reply_to = _addresses(message.reply_to)
+    if message.html_content:
+        msg.attach_alternative(message.html_content, "text/html")
+    msg.to = _addresses(message.to_address)
+    msg.cc = _addresses(message.cc_address)
+    msg.bcc = _addresses(message.bcc_address)
+    for attachment in message.attachment_set.all():
+        path = attachment.file_attachment.path
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                content = f.read()
+            msg.attach(attachment.original_filename, content, None)
+    return msg
+
+
+def recipient_domain(address):
+    return address.rsplit('@', 1)[-1].strip().lower()
+
+
+def _is_deferral(exception):
+    if isinstance(exception, smtplib.SMTPRecipientsRefused):
+        codes = [x[0] for x in exception.recipients.values()]
+        return bool(codes) and all([400 <= x < 500 for x in codes])
+    code = getattr(exception, 'smtp_code', None)
+    return code is not None and 400 <= code < 500
+
+
+class TokenBucket(object):
+    """ Allows rate messages per second, with bursts of capacity messages """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def available(self):
+        """ Whether a message can be sent now, without consuming it """
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return self.tokens >= 1
+
+    def consume(self):
+        if self.available():
+            self.tokens -= 1
+            return True
+        return False
+
+
+class FairScheduler(object):
+    """ Chooses which queued messages to send next
+
+        Pending messages are grouped by client, through the dispatch id
+        stored in the message app field, and picked round robin, so a big
+        campaign does not hold back the other clients messages.
+        Each recipient domain can be throttled with a token bucket, see
+        NEWSLETTER_DOMAIN_RATES: messages whose domain has no tokens left
+        are left in the queue.
+    """
+
+    def __init__(self, domain_rates=None, default_rate=None):
+        self.domain_rates = domain_rates if domain_rates is not None else getattr( # noqa
+            settings, 'NEWSLETTER_DOMAIN_RATES', {})
+        self.default_rate = default_rate or getattr(
+            settings, 'NEWSLETTER_DEFAULT_DOMAIN_RATE', None)
+        self.buckets = {}
+        # app: client id
+        self.clients = {}
+        self.turn = 0
+
+    def candidates(self, queryset, per_client, lock=False):
+        """ Returns the first per_client pending messages of every client,
+            messages of throttled domains are left out
+
+            With lock each client messages are claimed with a SELECT ...
+            FOR UPDATE SKIP LOCKED, it must run in a transaction.
+        """
+        queryset = self.exclude_throttled(queryset)
+        apps = list(queryset.order_by().values_list('app',
+                                                    flat=True).distinct())
+        self._map_clients(apps)
+        clients = {}
+        for app in apps:
+            clients.setdefault(self.clients.get(app), []).append(app)
+        candidates = {}
+        for client, client_apps in clients.items():
+            qs = queryset.filter(app__in=client_apps).order_by('pk')
+            if lock:
+                qs = qs.select_for_update(skip_locked=True)
+            candidates[client] = list(qs[:per_client])
+        return candidates
+
+    def exclude_throttled(self, queryset):
+        """ Leaves out the messages of the domains without tokens left """
+        for domain, bucket in self.buckets.items():
+            if not bucket.available():
+                queryset = queryset.exclude(to_address__iendswith='@' +
+                                            domain)
+        return queryset
+
+    def pick(self, candidates, size):
+        """ Picks up to size messages, one client at a time """
+        clients = sorted(candidates.keys(), key=lambda x: str(x))
+        if not clients:
+            return []
+        # start from a different client at every pick
+        self.turn = (self.turn + 1) % len(clients)
+        queues = [
+            deque(candidates[x]) for x in clients[self.turn:] + clients[:self.turn] # noqa
+        ]
+        picked = []
+        while queues and len(picked) < size:
+            for queue in list(queues):
+                while queue:
+                    message = queue.popleft()
+                    if self.allow(recipient_domain(message.to_address)):
+                        picked.append(message)
+                        break
+                if not queue:
+                    queues.remove(queue)
+                if len(picked) == size:
+                    break
+        return picked
+
+    def allow(self, domain):
+        rate = self.domain_rates.get(domain, self.default_rate)
+        if rate is None:
+            return True
+        if domain not in self.buckets:
+            self.buckets[domain] = TokenBucket(*rate)
+        return self.buckets[domain].consume()
+
+    def _map_clients(self, apps):
+        ids = [int(x) for x in apps if x not in self.clients and x.isdigit()]
+        for pk, client_id in Dispatch.objects.filter(pk__in=ids).values_list(
+                'id', 'campaign__client_id'):
+            self.clients[str(pk)] = client_id
+
+
+class PooledConnection(object):
+    """ A persistent mail backend connection, reopened when it fails """
+
+    def __init__(self):
+        self.connection = None
+
+    def send(self, email):
+        """ Sends the email, returns SENT, FAILED or DEFERRED """
+        for attempt in range(2):
+            try:
+                if self.connection is None:
+                    self.connection = get_connection(fail_silently=False)
+                    self.connection.open()
+                email.connection = self.connection
+                email.send()
+                return SENT
+            except smtplib.SMTPServerDisconnected:
+                # the server closed an idle connection, retry on a new one
+                self.close()
+            except (smtplib.SMTPRecipientsRefused,
+                    smtplib.SMTPSenderRefused) as e:
+                # the conversation is still usable
+                logger.error('Mail Queue Exception: {0}'.format(e))
+                return DEFERRED if _is_deferral(e) else FAILED
+            except Exception as e:
+                logger.error('Mail Queue Exception: {0}'.format(e))
+                self.close()
+                return DEFERRED if _is_deferral(e) else FAILED
+        return FAILED
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
+
+
+class DeliveryEngine(object):
+    """ Sends the queued messages over a pool of persistent connections
+
+        Each connection sends many messages in the same SMTP conversation
+        and runs in its own thread, messages are built in the calling
+        thread so the workers never touch the database. Sent and
+        last_attempt are written with a bulk update per batch.
+        After each send the average per message latency and the recipient
+        domains which deferred messages are available in latency and
+        deferred_domains.
+    """
+
+    def __init__(self, connections=None, batch_size=None):
+        self.pool_size = connections or getattr(
+            settings, 'NEWSLETTER_SMTP_CONNECTIONS', 4)
+        self.batch_size = batch_size or getattr(
+            settings, 'NEWSLETTER_DELIVERY_BATCH_SIZE', 200)
+        self.pool = [PooledConnection() for i in range(self.pool_size)]
+        self.executor = ThreadPoolExecutor(max_workers=self.pool_size)
+        self.sent = 0
+        self.failed = 0
+        self.latency = 0
+        self.deferred_domains = set()
+
+    def send(self, messages):
+        """ Sends the given MailerMessage objects, returns the ids of the
+            sent and failed messages (deferred ones count as failed)
+        """
+        emails = []
+        failed_ids = []
+        for message in messages:
+            try:
+                emails.append((message.pk, build_email(message),
+                               recipient_domain(message.to_address)))
+            except Exception as e:
+                logger.error('Mail Queue Exception: {0}'.format(e))
+                failed_ids.append(message.pk)
+        futures = [
+            self.executor.submit(self._send_many, connection,
+                                 emails[index::self.pool_size])
+            for index, connection in enumerate(self.pool)
+        ]
+        sent_ids = []
+        self.deferred_domains = set()
+        elapsed = 0
+        for future in futures:
+            outcomes, seconds = future.result()
+            elapsed += seconds
+            for pk, status, domain in outcomes:
+                if status == SENT:
+                    sent_ids.append(pk)
+                else:
+                    failed_ids.append(pk)
+                    if status == DEFERRED:
+                        self.deferred_domains.add(domain)
+        self.latency = elapsed / len(emails) if emails else 0
+        self.mark(sent_ids, failed_ids)
+        return sent_ids, failed_ids
+
+    def send_queued(self, limit=None, scheduler=None):
+        """ Sends up to limit unsent messages in batches chosen by the
+            scheduler, each message is tried once
+
+            Batches are claimed with SELECT ... FOR UPDATE SKIP LOCKED as
+            the QueueDrainer does, so overlapping runs and drainers never
+            send the same message.
+        """
+        if limit is None:
+            limit = getattr(settings, 'MAILQUEUE_LIMIT',
+                            mailqueue_defaults.MAILQUEUE_LIMIT)
+        limit = int(limit)
+        scheduler = scheduler or FairScheduler()
+        # failed messages get a newer last attempt and are left out
+        started_at = timezone.now()
+        queryset = MailerMessage.objects.filter(sent=False).filter(
+            Q(last_attempt__isnull=True) | Q(last_attempt__lt=started_at))
+        while limit > 0:
+            size = min(limit, self.batch_size)
+            with transaction.atomic():
+                batch = scheduler.pick(
+                    scheduler.candidates(queryset, size, lock=True), size)
+                if not batch:
+                    break
+                prefetch_related_objects(batch, 'attachment_set')
+                self.send(batch)
+            limit -= len(batch)
+
+    def mark(self, sent_ids, failed_ids):
+        """ Writes the delivery outcome of a batch """
+        now = timezone.now()
+        if sent_ids:
+            MailerMessage.objects.filter(pk__in=sent_ids).update(
+                sent=True, last_attempt=now)
+        if failed_ids:
+            MailerMessage.objects.filter(pk__in=failed_ids).update(
+                last_attempt=now)
+        self.sent += len(sent_ids)
+        self.failed += len(failed_ids)
+
+    def close(self):
+        self.executor.shutdown()
+        for connection in self.pool:
+            connection.close()
+
+    def _send_many(self, connection, emails):
+        start = time.monotonic()
+        outcomes = [(pk, connection.send(email), domain)
+                    for pk, email, domain in emails]
+        return outcomes, time.monotonic() - start
+
+
+class QueueDrainer(object):
+    """ Continuously sends the queued messages
+
+        Batches of unsent messages are claimed with SELECT ... FOR UPDATE
+        SKIP LOCKED and stay locked until they are marked, so many drainers
+        can run in parallel without sending a message twice.
+        Batch size and send rate follow an AIMD policy: they grow by a step
+        while the per message latency stays under target_latency and are
+        halved when it goes over or a domain defers messages. Domains which
+        defer messages are left out of the claims for an exponentially
+        growing backoff.
+        Messages are chosen by a FairScheduler and failed messages are
+        retried after NEWSLETTER_DRAINER_RETRY_DELAY seconds.
+    """
+
+    def __init__(self, engine, batch_size=None, max_batch_size=None,
+                 rate=None, max_rate=None, target_latency=None, idle=None,
+                 scheduler=None):
+        self.engine = engine
+        self.scheduler = scheduler or FairScheduler()
+        self.retry_delay = getattr(settings, 'NEWSLETTER_DRAINER_RETRY_DELAY',
+                                   300)
+        self.min_batch_size = 10
+        self.batch_size = batch_size or getattr(
+            settings, 'NEWSLETTER_DRAINER_BATCH_SIZE', 50)
+        self.max_batch_size = max_batch_size or getattr(
+            settings, 'NEWSLETTER_DRAINER_MAX_BATCH_SIZE', 1000)
+        self.min_rate = 1.0
+        self.rate = float(rate or getattr(
+            settings, 'NEWSLETTER_DRAINER_RATE', 50))
+        self.max_rate = float(max_rate or getattr(
+            settings, 'NEWSLETTER_DRAINER_MAX_RATE', 1000))
+        self.target_latency = target_latency or getattr(
+            settings, 'NEWSLETTER_DRAINER_TARGET_LATENCY', 0.5)
+        self.idle = idle or 5
+        # domain: (backoff seconds, retry timestamp)
+        self.backoff = {}
+        self.stopped = False
+
+    def stop(self, *args):
+        self.stopped = True
+
+    def run(self, once=False):
+        while not self.stopped:
+            claimed = self.drain()
+            if once and not claimed:
+                return
+            if not claimed:
+                time.sleep(self.idle)
+
+    def drain(self):
+        """ Claims and sends a batch, returns the number of messages """
+        start = time.monotonic()
+        with transaction.atomic():
+            # rows claimed by another drainer are skipped, the scheduler
+            # chooses among the ones locked for every client
+            batch = self.scheduler.pick(
+                self.scheduler.candidates(self.queryset(), self.batch_size,
+                                          lock=True), self.batch_size)
+            if batch:
+                prefetch_related_objects(batch, 'attachment_set')
+                self.engine.send(batch)
+        if batch:
+            self.adapt(self.engine.latency, self.engine.deferred_domains)
+        # keep the send rate
+        wait = len(batch) / self.rate - (time.monotonic() - start)
+        if wait > 0:
+            time.sleep(wait)
+        return len(batch)
+
+    def queryset(self):
+        qs = MailerMessage.objects.filter(sent=False).filter(
+            Q(last_attempt__isnull=True) | Q(last_attempt__lt=timezone.now() -
+                                             timedelta(seconds=self.retry_delay))) # noqa
+        now = time.monotonic()
+        for domain, (seconds, retry_at) in self.backoff.items():
+            if retry_at > now:
+                qs = qs.exclude(to_address__iendswith='@' + domain)
+        return qs
+
+    def adapt(self, latency, deferred_domains):
+        now = time.monotonic()
+        if deferred_domains or latency > self.target_latency:
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+            self.rate = max(self.min_rate, self.rate / 2)
+        else:
+            self.batch_size = min(self.max_batch_size,
+                                  self.batch_size + self.min_batch_size)
+            self.rate = min(self.max_rate, self.rate + self.min_rate * 5)
+        for domain in deferred_domains:
+            seconds = min(self.backoff.get(domain, (30, 0))[0] * 2, 3600)
+            self.backoff[domain] = (seconds, now + seconds)
+            logger.info('domain %s deferred messages, backing off %ds' % (
+                domain, seconds))
+        for domain, (seconds, retry_at) in list(self.backoff.items()):
+            if retry_at <= now and domain not in deferred_domains:
+                del self.backoff[domain]
@@ -0,0 +1,107 @@
+import logging
+
+from django.conf import settings
+from django.db import transaction
+
+from mailqueue import defaults as mailqueue_defaults
+from mailqueue.models import MailerMessage
+
+from .caching import invalidate_client_counts
+from .models import MailerMessageDispatch
+
+logger = logging.getLogger(__name__)
+
+
+class CheckpointError(Exception):
+    """ Raised by the checkpoint to stop the enqueuing, the messages of the
+        current transaction are discarded
+    """
+
+
+class MessageEnqueuer(object):
+    """ Accumulates the dispatch messages and writes them to the mail queue
+        with bulk inserts of batch_size rows
+
+        If a batch insert fails its messages are saved one by one, so that
+        failing addresses can be tracked.
+        When MAILQUEUE_QUEUE_UP is off messages are saved one by one, since
+        mailqueue sends them in its post_save receiver.
+        The checkpoint callable, if given, is called inside the transaction
+        which writes the messages, with the last subscriber id, the number
+        of written messages and the failing addresses, it can raise
+        CheckpointError to stop.
+        Every written message is linked to the dispatch and its client
+        through MailerMessageDispatch.
+    """
+
+    def __init__(self, dispatch, batch_size=None, checkpoint=None):
+        self.dispatch = dispatch
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size or getattr(
+            settings, 'NEWSLETTER_ENQUEUE_BATCH_SIZE', 500)
+        self.bulk = getattr(settings, 'MAILQUEUE_QUEUE_UP',
+                            mailqueue_defaults.MAILQUEUE_QUEUE_UP)
+        self.pending = []
+        self.sent = 0
+        self.error_addresses = []
+
+    def add(self, msg, subscriber_id=None):
+        self.pending.append((msg, subscriber_id))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Writes the pending messages """
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        if self.bulk:
+            try:
+                with transaction.atomic():
+                    last_id = MailerMessage.objects.order_by(
+                        '-id').values_list('id', flat=True).first() or 0
+                    messages = MailerMessage.objects.bulk_create(
+                        [x[0] for x in batch])
+                    self._link(messages, last_id)
+                    self._checkpoint(batch[-1][1], len(batch), [])
+                self.sent += len(batch)
+                return
+            except CheckpointError:
+                raise
+            except Exception:
+                logger.exception(
+                    'dispatch %s: bulk insert of %d messages failed, saving them one by one' # noqa
+                    % (self.dispatch.pk, len(batch)))
+        for msg, subscriber_id in batch:
+            try:
+                with transaction.atomic():
+                    msg.save()
+                    self._link([msg])
+                    self._checkpoint(subscriber_id, 1, [])
+                self.sent += 1
+            except CheckpointError:
+                raise
+            except Exception:
+                self._checkpoint(subscriber_id, 0, [msg.to_address])
+                self.error_addresses.append(msg.to_address)
+
+    def _link(self, messages, last_id=None):
+        ids = [x.pk for x in messages if x.pk is not None]
+        if len(ids) < len(messages):
+            # the backend (MySQL) does not return the bulk inserted ids,
+            # they are the ones of this dispatch written after last_id
+            ids = MailerMessage.objects.filter(
+                id__gt=last_id, app=str(self.dispatch.pk)).values_list(
+                    'id', flat=True)
+        MailerMessageDispatch.objects.bulk_create([
+            MailerMessageDispatch(message_id=pk,
+                                  dispatch_id=self.dispatch.pk,
+                                  client_id=self.dispatch.campaign.client_id)
+            for pk in ids
+        ], ignore_conflicts=True)
+        invalidate_client_counts(self.dispatch.campaign.client_id,
+                                 MailerMessage)
+
+    def _checkpoint(self, subscriber_id, sent, error_addresses):
+        if self.checkpoint is not None:
+            self.checkpoint(subscriber_id, sent, error_addresses)
@@ -0,0 +1,173 @@
+import codecs
+import csv
+import json
+from datetime import datetime
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import transaction
+from django.utils import timezone
+
+from .caching import invalidate_client_counts
+from .models import DailyStats, Subscriber
+
+
+class RowError(Exception):
+    pass
+
+
+class SubscribersImport(object):
+    """ Streaming, set based import of subscribers from a csv file
+
+        Rows (email, subscription datetime, info, opt in[, opt in datetime])
+        are parsed and validated chunk_size at a time. Each chunk inserts
+        the new subscribers and the missing lists memberships with
+        bulk inserts ignoring conflicts on (client, email) and (subscriber,
+        list). Invalid rows are rejected and reported without stopping the
+        import.
+        The progress callable, if given, is called with the import after
+        each chunk.
+    """
+    max_errors = 100
+
+    def __init__(self, client, lists_ids, chunk_size=None, progress=None):
+        self.client = client
+        self.progress = progress
+        self.lists_ids = [int(x) for x in lists_ids]
+        self.chunk_size = chunk_size or getattr(
+            settings, 'NEWSLETTER_IMPORT_CHUNK_SIZE', 1000)
+        self.processed = 0
+        self.inserted = 0
+        self.existing = 0
+        self.rejected = 0
+        # line and message of the first max_errors rejected rows
+        self.errors = []
+
+    def run(self, file):
+        """ Imports the rows of a binary file object """
+        reader = csv.reader(codecs.iterdecode(file, 'utf-8'))
+        chunk = []
+        for row in reader:
+            chunk.append((reader.line_num, row))
+            if len(chunk) == self.chunk_size:
+                self.import_chunk(chunk)
+                chunk = []
+                if self.progress is not None:
+                    self.progress(self)
+        if chunk:
+            self.import_chunk(chunk)
+        invalidate_client_counts(self.client.pk, Subscriber)
+        return self
+
+    def import_chunk(self, rows):
+        # email (case insensitive): values, the first occurrence wins
+        subscribers = {}
+        # emails as written in the file
+        emails = set()
+        duplicates = 0
+        for line, row in rows:
+            self.processed += 1
+            try:
+                values = self.parse(row)
+            except RowError as e:
+                self.reject(line, str(e))
+                continue
+            emails.add(values['email'])
+            if values['email'].lower() in subscribers:
+                duplicates += 1
+                continue
+            subscribers[values['email'].lower()] = values
+        # repeated rows count as existing subscribers
+        self.existing += duplicates
+        if not subscribers:
+            return
+        emails.update(subscribers.keys())
+        with transaction.atomic():
+            existing = self.subscriber_ids(emails)
+            Subscriber.objects.bulk_create([
+                Subscriber(client=self.client, **values)
+                for email, values in subscribers.items()
+                if email not in existing
+            ], ignore_conflicts=True)
+            ids = self.subscriber_ids(emails)
+            Through = Subscriber.lists.through
+            Through.objects.bulk_create([
+                Through(subscriber_id=subscriber_id, subscriberlist_id=list_id)
+                for subscriber_id in ids.values() for list_id in self.lists_ids
+            ], ignore_conflicts=True)
+            DailyStats.increment(self.client.pk, timezone.localdate(),
+                                 subscriptions=len(ids) - len(existing))
+        self.existing += len(existing)
+        self.inserted += len(ids) - len(existing)
+
+    def subscriber_ids(self, emails):
+        """ Lowercase email: id of the client subscribers with the given
+            emails, matched through the (client, email) index, so case
+            insensitively with the MySQL collation
+        """
+        return dict([
+            (email.lower(), pk)
+            for pk, email in Subscriber.objects.filter(
+                client=self.client, email__in=list(emails)).values_list(
+                    'id', 'email')
+        ])
+
+    def parse(self, row):
+        if len(row) != 5 and len(row) != 4:
+            raise RowError('Il file importato non è del formato corretto')
+        email = row[0].strip()
+        subscription_datetime = row[1].strip()
+        info = row[2]
+        try:
+            opt_in = int(row[3])
+        except ValueError:
+            raise RowError('%s: il campo opt in deve essere 0 o 1' % email)
+        opt_in_datetime = None
+        if opt_in:
+            opt_in_datetime = row[4].strip() if len(row) == 5 else None
+            if not opt_in_datetime:
+                raise RowError(
+                    '%s: in caso di opt in ad 1 deve essere specificata la data' # noqa
+                    % email)
+        try:
+            validate_email(email)
+        except Exception:
+            raise RowError('%s non è un indirizzo e-mail valido' % email)
+        if not subscription_datetime:
+            subscription_datetime = datetime.now()
+        try:
+            subscription_datetime = self.to_datetime(subscription_datetime)
+            opt_in_datetime = self.to_datetime(opt_in_datetime)
+        except ValidationError:
+            raise RowError('%s: data non valida' % email)
+        if info:
+            try:
+                json.loads(info)
+            except ValueError:
+                raise RowError(
+                    'La colonna informazioni deve contenere un JSON valido')
+        return {
+            'email': email,
+            'subscription_datetime': subscription_datetime,
+            'info': info,
+            'opt_in': bool(opt_in),
+            'opt_in_datetime': opt_in_datetime,
+        }
+
+    def to_datetime(self, value):
+        return Subscriber._meta.get_field('opt_in_datetime').to_python(value)
+
+    def reject(self, line, message):
+        self.rejected += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line': line, 'detail': message})
+
+    def report(self):
+        return {
+            'processed': self.processed,
+            'inserted': self.inserted,
+            'existing': self.existing,
+            'rejected': self.rejected,
+            'errors': self.errors,
+        }
@@ -0,0 +1,21 @@
+# Set a cronjob to make it work.
+from django.core.management.base import BaseCommand
+
+from ...tracking import ingest_events
+
+
+class Command(BaseCommand):
+    help = 'Stores the buffered open and click tracking events'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            action='store',
+            type=int,
+            dest='batch_size',
+            help='Number of events processed at a time',
+        )
+
+    def handle(self, *args, **options):
+        created = ingest_events(batch_size=options['batch_size'])
+        self.stdout.write('%d tracking events stored' % created)
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from ...models import Dispatch, DispatchStats
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the dispatches statistics from trackings and bounces'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dispatch_ids', nargs='*', type=int)
+
+    def handle(self, *args, **options):
+        dispatch_ids = options['dispatch_ids'] or Dispatch.objects.values_list(
+            'id', flat=True)
+        count = 0
+        for dispatch_id in dispatch_ids:
+            DispatchStats.rebuild(dispatch_id)
+            count += 1
+        self.stdout.write('%d dispatches statistics rebuilt' % count)
@@ -0,0 +1,27 @@
+# Set a cronjob (or run it after a deploy) to make it work.
+from django.core.management.base import BaseCommand
+
+from ...models import DispatchShard
+from ...tasks import send_campaign_shard
+
+
+class Command(BaseCommand):
+    help = 'Resumes the dispatches interrupted by a worker crash or restart'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dispatch_ids', nargs='*', type=int)
+        parser.add_argument(
+            '--stale',
+            type=int,
+            default=15,
+            help='minutes after which a shard never started is resumed')
+
+    def handle(self, *args, **options):
+        shards = DispatchShard.stale(options['stale'])
+        if options['dispatch_ids']:
+            shards = shards.filter(dispatch__id__in=options['dispatch_ids'])
+        # shards running in another worker are leased, so not stale
+        shard_ids = list(shards.values_list('pk', flat=True))
+        for shard_id in shard_ids:
+            send_campaign_shard.delay(shard_id)
+        self.stdout.write('%d shards resumed' % len(shard_ids))
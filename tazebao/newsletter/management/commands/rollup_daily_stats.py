@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ...models import DailyStats
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the clients daily stats of the last days, to be run nightly' # noqa
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=2,
+            help='number of days to recompute, today included')
+        parser.add_argument('client_ids', nargs='*', type=int)
+
+    def handle(self, *args, **options):
+        date_to = timezone.localdate()
+        date_from = date_to - timedelta(days=max(options['days'], 1) - 1)
+        count = DailyStats.rebuild(date_from, date_to,
+                                   options['client_ids'] or None)
+        self.stdout.write('%d daily stats rows rebuilt' % count)
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.2 on 2026-10-18 09:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('newsletter', '0055_systemmessage_title'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DispatchShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_subscriber_id', models.IntegerField(verbose_name='primo iscritto')),
+                ('last_subscriber_id', models.IntegerField(verbose_name='ultimo iscritto')),
+                ('sent', models.IntegerField(default=0, verbose_name='e-mail inviate')),
+                ('error_recipients', models.TextField(blank=True, null=True, verbose_name='indirizzi in errore')),
+                ('done', models.BooleanField(default=False, verbose_name='completato')),
+                ('dispatch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shards', to='newsletter.Dispatch', verbose_name='invio')),
+            ],
+            options={
+                'verbose_name': 'blocco invio',
+                'verbose_name_plural': 'blocchi invio',
+            },
+        ),
+    ]
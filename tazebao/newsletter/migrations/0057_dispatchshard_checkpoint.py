@@ -0,0 +1,23 @@
+# Generated by Django 2.2.2 on 2026-10-18 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('newsletter', '0056_dispatchshard'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dispatchshard',
+            name='checkpoint',
+            field=models.IntegerField(blank=True, null=True, verbose_name='ultimo iscritto accodato'),
+        ),
+        migrations.AddField(
+            model_name='dispatchshard',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, verbose_name='ultimo aggiornamento'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 2.2.2 on 2026-10-18 11:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def link_messages(apps, schema_editor):
+    """ Links the existing queued messages to their dispatch, with a single
+        pk ordered pass over the mail queue, chunk by chunk
+    """
+    Dispatch = apps.get_model('newsletter', 'Dispatch')
+    MailerMessage = apps.get_model('mailqueue', 'MailerMessage')
+    MailerMessageDispatch = apps.get_model('newsletter',
+                                           'MailerMessageDispatch')
+    # app (dispatch id): client id
+    clients = dict([
+        (str(pk), client_id) for pk, client_id in
+        Dispatch.objects.values_list('id', 'campaign__client_id')
+    ])
+    last_id = 0
+    while True:
+        rows = list(
+            MailerMessage.objects.filter(id__gt=last_id).order_by(
+                'id').values_list('id', 'app')[:5000])
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        MailerMessageDispatch.objects.bulk_create([
+            MailerMessageDispatch(message_id=pk,
+                                  dispatch_id=int(app),
+                                  client_id=clients[app])
+            for pk, app in rows if app in clients
+        ], ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailqueue', '0005_cc_address_created'),
+        ('newsletter', '0057_dispatchshard_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailerMessageDispatch',
+            fields=[
+                ('message', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='dispatch_link', serialize=False, to='mailqueue.MailerMessage', verbose_name='messaggio')),
+                ('client', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='newsletter.Client', verbose_name='client')),
+                ('dispatch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='newsletter.Dispatch', verbose_name='invio')),
+            ],
+            options={
+                'verbose_name': 'invio messaggio',
+                'verbose_name_plural': 'invii messaggi',
+            },
+        ),
+        migrations.RunPython(link_messages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.2.2 on 2026-10-18 12:02
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('newsletter', '0058_mailermessagedispatch'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='tracking',
+            name='datetime',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
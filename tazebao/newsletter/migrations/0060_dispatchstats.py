@@ -0,0 +1,29 @@
+# Generated by Django 2.2.2 on 2026-10-18 12:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('newsletter', '0059_tracking_datetime_default'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DispatchStats',
+            fields=[
+                ('dispatch', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='newsletter.Dispatch', verbose_name='invio')),
+                ('unique_opens', models.IntegerField(default=0, verbose_name='aperture uniche')),
+                ('total_opens', models.IntegerField(default=0, verbose_name='aperture totali')),
+                ('unique_clickers', models.IntegerField(default=0, verbose_name='iscritti che hanno cliccato')),
+                ('total_clicks', models.IntegerField(default=0, verbose_name='click totali')),
+                ('bounces', models.IntegerField(default=0, verbose_name='bounces')),
+            ],
+            options={
+                'verbose_name': 'statistiche invio',
+                'verbose_name_plural': 'statistiche invii',
+            },
+        ),
+    ]
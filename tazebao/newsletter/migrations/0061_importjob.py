@@ -0,0 +1,38 @@
+# Generated by Django 2.2.2 on 2026-10-18 14:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+import newsletter.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('newsletter', '0060_dispatchstats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FileField(blank=True, storage=newsletter.models.ImportStorage(), upload_to='%Y/%m/', verbose_name='file')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='data creazione')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='inizio')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='fine')),
+                ('phase', models.CharField(choices=[('queued', 'in coda'), ('running', 'in corso'), ('completed', 'completata'), ('failed', 'fallita')], default='queued', max_length=20, verbose_name='fase')),
+                ('processed', models.IntegerField(default=0, verbose_name='righe elaborate')),
+                ('inserted', models.IntegerField(default=0, verbose_name='iscritti inseriti')),
+                ('updated', models.IntegerField(default=0, verbose_name='iscritti esistenti aggiornati')),
+                ('rejected', models.IntegerField(default=0, verbose_name='righe scartate')),
+                ('errors', models.TextField(blank=True, null=True, verbose_name='errori (JSON)')),
+                ('error_message', models.TextField(blank=True, null=True, verbose_name='messaggio di errore')),
+                ('client', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='newsletter.Client', verbose_name='client')),
+                ('lists', models.ManyToManyField(to='newsletter.SubscriberList', verbose_name='liste')),
+            ],
+            options={
+                'verbose_name': 'importazione iscritti',
+                'verbose_name_plural': 'importazioni iscritti',
+            },
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 2.2.2 on 2026-10-18 16:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def rollup_history(apps, schema_editor):
+    """ Computes the daily stats of the whole history """
+    DailyStats = apps.get_model('newsletter', 'DailyStats')
+    sources = (
+        ('subscriptions', apps.get_model('newsletter', 'Subscriber'),
+         'subscription_datetime'),
+        ('unsubscriptions', apps.get_model('newsletter', 'Unsubscription'),
+         'datetime'),
+        ('bounces', apps.get_model('newsletter', 'FailedEmail'), 'datetime'),
+    )
+    rows = {}
+    for counter, model, field in sources:
+        for client_id, day, count in model.objects.exclude(**{
+                field + '__isnull': True
+        }).order_by().values_list('client_id', field + '__date').annotate(
+                count=models.Count('id')):
+            rows.setdefault((client_id, day), {})[counter] = count
+    DailyStats.objects.bulk_create([
+        DailyStats(client_id=client_id, date=day, **counters)
+        for (client_id, day), counters in rows.items()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('newsletter', '0061_importjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='data')),
+                ('subscriptions', models.IntegerField(default=0, verbose_name='iscrizioni')),
+                ('unsubscriptions', models.IntegerField(default=0, verbose_name='disiscrizioni')),
+                ('bounces', models.IntegerField(default=0, verbose_name='bounces')),
+                ('client', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='newsletter.Client', verbose_name='client')),
+            ],
+            options={
+                'verbose_name': 'statistiche giornaliere',
+                'verbose_name_plural': 'statistiche giornaliere',
+                'ordering': ('date',),
+                'unique_together': {('client', 'date')},
+            },
+        ),
+        migrations.RunPython(rollup_history, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.2 on 2026-10-18 18:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('newsletter', '0062_dailystats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dispatchshard',
+            name='claimed_by',
+            field=models.CharField(blank=True, max_length=32, null=True, verbose_name='assegnato a'),
+        ),
+        migrations.AddField(
+            model_name='dispatchshard',
+            name='claimed_until',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='assegnato fino a'),
+        ),
+        migrations.AddField(
+            model_name='dispatchshard',
+            name='attempts',
+            field=models.IntegerField(default=0, verbose_name='tentativi'),
+        ),
+    ]
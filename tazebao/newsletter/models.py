@@ -1,18 +1,26 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import datetime
+import os
+
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
 from django.db.models.fields import uuid
 from django.utils import timezone
 from django.utils.formats import date_format
 from django.utils.safestring import mark_safe
-from django.db.models.signals import pre_delete
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
 from ckeditor_uploader.fields import RichTextUploadingField
 
 from mailqueue.models import MailerMessage
 
+from .caching import invalidate_client_counts
+
 
 class Client(models.Model):
     user = models.OneToOneField(
@@ -257,32 +265,156 @@ class Dispatch(models.Model):
                                      timezone.localtime(self.started_at),
                                      'DATETIME_FORMAT'))  # noqa
 
+    def get_stats(self):
+        return DispatchStats.for_dispatch(self)
+
     def open_rate(self):
         if self.error or not self.open_statistics:
             return None
-        trackings = Tracking.objects.filter(
-            dispatch=self, type=Tracking.OPEN_TYPE).count()  # noqa
+        trackings = self.get_stats().unique_opens
         perc = round(100 * trackings / float(self.sent), 1)
         return perc
 
     def unopen_rate(self):
-        if self.open_rate() is None:
+        open_rate = self.open_rate()
+        if open_rate is None:
             return None
-        return round(100 - float(self.open_rate()), 1)
+        return round(100 - float(open_rate), 1)
 
     def click_rate(self):
         if self.error or not self.click_statistics:
             return None
-        clicks_s = Tracking.objects.filter(
-            dispatch=self, type=Tracking.CLICK_TYPE).values(
-                'subscriber').distinct().count()  # noqa
+        clicks_s = self.get_stats().unique_clickers
         perc = round(100 * clicks_s / float(self.sent), 1)
         return perc
 
     def unclick_rate(self):
-        if self.click_rate() is None:
+        click_rate = self.click_rate()
+        if click_rate is None:
             return None
-        return round(100 - float(self.click_rate()), 1)
+        return round(100 - float(click_rate), 1)
+
+
+class DispatchShard(models.Model):
+    """ Subscribers id range of a dispatch rendered by its own task """
+    dispatch = models.ForeignKey(
+        Dispatch,
+        verbose_name='invio',
+        on_delete=models.CASCADE,
+        related_name='shards')
+    first_subscriber_id = models.IntegerField('primo iscritto')
+    last_subscriber_id = models.IntegerField('ultimo iscritto')
+    sent = models.IntegerField('e-mail inviate', default=0)
+    error_recipients = models.TextField(
+        'indirizzi in errore', blank=True, null=True)
+    done = models.BooleanField('completato', default=False)
+    checkpoint = models.IntegerField(
+        'ultimo iscritto accodato', blank=True, null=True)
+    updated_at = models.DateTimeField('ultimo aggiornamento', auto_now=True)
+    claimed_by = models.CharField(
+        'assegnato a', max_length=32, blank=True, null=True)
+    claimed_until = models.DateTimeField(
+        'assegnato fino a', blank=True, null=True)
+    attempts = models.IntegerField('tentativi', default=0)
+
+    class Meta:
+        verbose_name = 'blocco invio'
+        verbose_name_plural = 'blocchi invio'
+
+    @classmethod
+    def stale(cls, minutes):
+        """ Unfinished shards whose lease expired, or never claimed since
+            minutes ago (their task was lost before it started)
+        """
+        now = timezone.now()
+        return cls.objects.filter(done=False).filter(
+            models.Q(claimed_until__lt=now) | models.Q(
+                claimed_until__isnull=True,
+                updated_at__lte=now - datetime.timedelta(minutes=minutes)))
+
+    def __str__(self):
+        return '%s (%s - %s)' % (self.dispatch_id, self.first_subscriber_id,
+                                 self.last_subscriber_id)
+
+
+class DispatchStats(models.Model):
+    """ Tracking and bounces counters of a dispatch, kept up to date by the
+        tracking and bounces ingestion
+    """
+    dispatch = models.OneToOneField(
+        Dispatch,
+        verbose_name='invio',
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='stats')
+    unique_opens = models.IntegerField('aperture uniche', default=0)
+    total_opens = models.IntegerField('aperture totali', default=0)
+    unique_clickers = models.IntegerField('iscritti che hanno cliccato',
+                                          default=0)
+    total_clicks = models.IntegerField('click totali', default=0)
+    bounces = models.IntegerField('bounces', default=0)
+
+    class Meta:
+        verbose_name = 'statistiche invio'
+        verbose_name_plural = 'statistiche invii'
+
+    def __str__(self):
+        return 'statistiche invio %s' % self.dispatch_id
+
+    @classmethod
+    def for_dispatch(cls, dispatch):
+        """ Returns the dispatch stats, computing them if missing """
+        try:
+            return dispatch.stats
+        except cls.DoesNotExist:
+            return cls.rebuild(dispatch.pk)
+
+    @classmethod
+    def ensure(cls, dispatch_ids):
+        """ Computes the missing stats of the given dispatches """
+        existing = cls.objects.filter(
+            dispatch_id__in=dispatch_ids).values_list('dispatch_id', flat=True)
+        for dispatch_id in set(dispatch_ids) - set(existing):
+            cls.rebuild(dispatch_id)
+
+    @classmethod
+    def rebuild(cls, dispatch_id):
+        """ Recomputes the stats from the stored rows, total opens can only
+            count the stored (unique) opens
+        """
+        opens = Tracking.objects.filter(dispatch_id=dispatch_id,
+                                        type=Tracking.OPEN_TYPE)
+        clicks = Tracking.objects.filter(dispatch_id=dispatch_id,
+                                         type=Tracking.CLICK_TYPE)
+        values = {
+            'unique_opens': opens.values('subscriber').distinct().count(),
+            'total_opens': opens.count(),
+            'unique_clickers': clicks.values('subscriber').distinct().count(),
+            'total_clicks': clicks.count(),
+            'bounces': FailedEmail.objects.filter(
+                dispatch_id=dispatch_id).count(),
+        }
+        try:
+            with transaction.atomic():
+                stats, created = cls.objects.update_or_create(
+                    dispatch_id=dispatch_id, defaults=values)
+        except IntegrityError:
+            # created meanwhile by another process
+            stats = cls.objects.get(dispatch_id=dispatch_id)
+        return stats
+
+    @classmethod
+    def increment(cls, dispatch_id, **counters):
+        """ Adds the given values to the dispatch counters """
+        counters = dict([(k, F(k) + v) for k, v in counters.items() if v])
+        if counters:
+            cls.objects.filter(dispatch_id=dispatch_id).update(**counters)
+
+
+@receiver(post_save, sender=Dispatch)
+def create_dispatch_stats(sender, instance, created, **kwargs):
+    if created:
+        DispatchStats.objects.create(dispatch=instance)
 
 
 class Tracking(models.Model):
@@ -292,7 +424,8 @@ class Tracking(models.Model):
         (OPEN_TYPE, 'apertura'),
         (CLICK_TYPE, 'click'),
     )
-    datetime = models.DateTimeField(auto_now_add=True)
+    # set by the ingestion to the time of the event
+    datetime = models.DateTimeField(default=timezone.now, editable=False)
     type = models.IntegerField('tipo', choices=TYPE_CHOICES)
     dispatch = models.ForeignKey(
         Dispatch,
@@ -318,6 +451,35 @@ class UserMailerMessage(MailerMessage):
         verbose_name_plural = 'log invii'
 
 
+class MailerMessageDispatch(models.Model):
+    """ Indexed link between a queued message and its dispatch and client,
+        the message app field stores the dispatch id as unindexed text
+    """
+    message = models.OneToOneField(
+        MailerMessage,
+        verbose_name='messaggio',
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='dispatch_link')
+    dispatch = models.ForeignKey(
+        Dispatch,
+        verbose_name='invio',
+        on_delete=models.CASCADE,
+        related_name='messages')
+    client = models.ForeignKey(
+        Client,
+        verbose_name='client',
+        on_delete=models.CASCADE,
+        related_name='messages')
+
+    class Meta:
+        verbose_name = 'invio messaggio'
+        verbose_name_plural = 'invii messaggi'
+
+    def __str__(self):
+        return '%s - %s' % (self.message_id, self.dispatch_id)
+
+
 class FailedEmail(models.Model):
     client = models.ForeignKey(
         Client, verbose_name='client', on_delete=models.CASCADE)
@@ -368,6 +530,106 @@ def log_unsubscription(sender, instance, using, **kwargs):
     unsubscription.save()
 
 
+def local_date(value):
+    """ Date of a datetime in the current timezone, as the __date lookups """
+    if timezone.is_aware(value):
+        value = timezone.localtime(value)
+    return value.date()
+
+
+class DailyStats(models.Model):
+    """ Subscriptions, unsubscriptions and bounces of a client per day
+
+        The rows aggregate the stored subscribers (by subscription date),
+        unsubscriptions and bounces: they are incremented by the write paths
+        and recomputed by the rollup_daily_stats command.
+    """
+    client = models.ForeignKey(
+        Client,
+        verbose_name='client',
+        on_delete=models.CASCADE,
+        related_name='daily_stats')
+    date = models.DateField('data')
+    subscriptions = models.IntegerField('iscrizioni', default=0)
+    unsubscriptions = models.IntegerField('disiscrizioni', default=0)
+    bounces = models.IntegerField('bounces', default=0)
+
+    class Meta:
+        verbose_name = 'statistiche giornaliere'
+        verbose_name_plural = 'statistiche giornaliere'
+        unique_together = ('client', 'date', )
+        ordering = ('date', )
+
+    def __str__(self):
+        return '%s - %s' % (self.client_id, self.date)
+
+    @property
+    def net(self):
+        return self.subscriptions - self.unsubscriptions
+
+    @classmethod
+    def sources(cls):
+        """ Counter, model and datetime field of the aggregated rows """
+        return (
+            ('subscriptions', Subscriber, 'subscription_datetime'),
+            ('unsubscriptions', Unsubscription, 'datetime'),
+            ('bounces', FailedEmail, 'datetime'),
+        )
+
+    @classmethod
+    def increment(cls, client_id, day, **counters):
+        """ Adds the given values to the counters of a client day """
+        counters = dict([(k, v) for k, v in counters.items() if v])
+        if not counters:
+            return
+        updates = dict([(k, F(k) + v) for k, v in counters.items()])
+        if cls.objects.filter(client_id=client_id, date=day).update(**updates):
+            return
+        if min(counters.values()) < 0:
+            # nothing to decrement, the client may be being deleted
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(client_id=client_id, date=day, **counters)
+        except IntegrityError:
+            # created meanwhile by another process
+            cls.objects.filter(client_id=client_id, date=day).update(**updates)
+
+    @classmethod
+    def rebuild(cls, date_from, date_to, client_ids=None):
+        """ Recomputes the rows of the days from date_from to date_to
+            (included) from the stored rows, returns their number
+        """
+        start = timezone.make_aware(
+            datetime.datetime.combine(date_from, datetime.time.min))
+        end = timezone.make_aware(
+            datetime.datetime.combine(date_to + datetime.timedelta(days=1),
+                                      datetime.time.min))
+        # (client id, date): counters
+        rows = {}
+        for counter, model, field in cls.sources():
+            qs = model.objects.filter(**{
+                field + '__gte': start,
+                field + '__lt': end
+            })
+            if client_ids is not None:
+                qs = qs.filter(client_id__in=client_ids)
+            for client_id, day, count in qs.order_by().values_list(
+                    'client_id', field + '__date').annotate(
+                        count=models.Count('id')):
+                rows.setdefault((client_id, day), {})[counter] = count
+        with transaction.atomic():
+            qs = cls.objects.filter(date__gte=date_from, date__lte=date_to)
+            if client_ids is not None:
+                qs = qs.filter(client_id__in=client_ids)
+            qs.delete()
+            cls.objects.bulk_create([
+                cls(client_id=client_id, date=day, **counters)
+                for (client_id, day), counters in rows.items()
+            ], batch_size=1000)
+        return len(rows)
+
+
 class SubscriptionForm(models.Model):
     client = models.ForeignKey(Client, verbose_name='client', on_delete=models.CASCADE)
     created = models.DateTimeField(verbose_name='data creazione', auto_now_add=True)
@@ -388,6 +650,54 @@ class SubscriptionForm(models.Model):
         return self.name
 
 
+class ImportStorage(FileSystemStorage):
+    """ Uploaded import files, kept outside the public media root """
+
+    def __init__(self):
+        super(ImportStorage, self).__init__(
+            location=getattr(settings, 'NEWSLETTER_IMPORTS_ROOT',
+                             os.path.join(settings.BASE_DIR, 'imports')),
+            base_url=None)
+
+
+class ImportJob(models.Model):
+    """ Subscribers csv import run in background """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+    PHASE_CHOICES = (
+        (QUEUED, 'in coda'),
+        (RUNNING, 'in corso'),
+        (COMPLETED, 'completata'),
+        (FAILED, 'fallita'),
+    )
+    client = models.ForeignKey(
+        Client, verbose_name='client', on_delete=models.CASCADE)
+    lists = models.ManyToManyField(SubscriberList, verbose_name='liste')
+    file = models.FileField(
+        'file', upload_to='%Y/%m/', storage=ImportStorage(), blank=True)
+    created = models.DateTimeField('data creazione', auto_now_add=True)
+    started_at = models.DateTimeField('inizio', blank=True, null=True)
+    finished_at = models.DateTimeField('fine', blank=True, null=True)
+    phase = models.CharField(
+        'fase', max_length=20, choices=PHASE_CHOICES, default=QUEUED)
+    processed = models.IntegerField('righe elaborate', default=0)
+    inserted = models.IntegerField('iscritti inseriti', default=0)
+    updated = models.IntegerField('iscritti esistenti aggiornati', default=0)
+    rejected = models.IntegerField('righe scartate', default=0)
+    errors = models.TextField('errori (JSON)', blank=True, null=True)
+    error_message = models.TextField(
+        'messaggio di errore', blank=True, null=True)
+
+    class Meta:
+        verbose_name = 'importazione iscritti'
+        verbose_name_plural = 'importazioni iscritti'
+
+    def __str__(self):
+        return 'importazione %s' % self.id
+
+
 class SuggestionRequest(models.Model):
     client = models.ForeignKey(Client, verbose_name='client', on_delete=models.CASCADE)
     datetime = models.DateTimeField(verbose_name='data e ora', auto_now_add=True)
@@ -401,3 +711,62 @@ class SuggestionRequest(models.Model):
     def __str__(self):
         return str(self.id)
 
+
+@receiver(post_save, sender=Subscriber)
+@receiver(post_save, sender=SubscriberList)
+@receiver(post_save, sender=Campaign)
+@receiver(post_save, sender=Topic)
+@receiver(post_save, sender=FailedEmail)
+@receiver(post_save, sender=SubscriptionForm)
+@receiver(post_save, sender=Planning)
+@receiver(post_save, sender=Dispatch)
+def invalidate_counts_on_save(sender, instance, created, **kwargs):
+    if created:
+        invalidate_counts(sender, instance)
+
+
+@receiver(post_delete, sender=Subscriber)
+@receiver(post_delete, sender=SubscriberList)
+@receiver(post_delete, sender=Campaign)
+@receiver(post_delete, sender=Topic)
+@receiver(post_delete, sender=FailedEmail)
+@receiver(post_delete, sender=SubscriptionForm)
+@receiver(post_delete, sender=Planning)
+@receiver(post_delete, sender=Dispatch)
+def invalidate_counts_on_delete(sender, instance, **kwargs):
+    invalidate_counts(sender, instance)
+
+
+def invalidate_counts(sender, instance):
+    """ Drops the cached client count of the instance model """
+    if sender in (Planning, Dispatch):
+        client_id = Campaign.objects.filter(
+            pk=instance.campaign_id).values_list('client_id', flat=True).first()
+    else:
+        client_id = instance.client_id
+    if client_id is not None:
+        invalidate_client_counts(client_id, sender)
+
+
+@receiver(post_save, sender=Subscriber)
+@receiver(post_save, sender=Unsubscription)
+@receiver(post_save, sender=FailedEmail)
+def increment_daily_stats(sender, instance, created, **kwargs):
+    if created:
+        update_daily_stats(sender, instance, 1)
+
+
+@receiver(post_delete, sender=Subscriber)
+@receiver(post_delete, sender=Unsubscription)
+@receiver(post_delete, sender=FailedEmail)
+def decrement_daily_stats(sender, instance, **kwargs):
+    update_daily_stats(sender, instance, -1)
+
+
+def update_daily_stats(sender, instance, value):
+    """ Adds value to the daily counter of the instance model """
+    for counter, model, field in DailyStats.sources():
+        if model is sender and getattr(instance, field) is not None:
+            DailyStats.increment(instance.client_id,
+                                 local_date(getattr(instance, field)),
+                                 **{counter: value})
@@ -0,0 +1,145 @@
+import base64
+import json
+from collections import OrderedDict
+from datetime import date
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """ Keyset (cursor) pagination on (sort key, id)
+
+        Each page is read with a WHERE on the last row of the previous page
+        instead of an OFFSET, so its cost does not depend on its depth.
+        The sort key is the first ordering field of the queryset, nullable
+        or multi valued keys fall back to id. The total count is added only
+        on request: count=exact or count=approx (table statistics estimate,
+        MySQL only).
+    """
+    cursor_query_param = 'cursor'
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    count_query_param = 'count'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.key, self.descending = self.get_sort_key(queryset)
+        self.count = self.get_count(queryset, request)
+        prefix = '-' if self.descending else ''
+        ordering = [prefix + 'id']
+        if self.key != 'id':
+            ordering.insert(0, prefix + self.key)
+        queryset = queryset.order_by(*ordering)
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            queryset = queryset.filter(self.after(*cursor))
+        page = list(queryset[:self.page_size + 1])
+        self.has_next = len(page) > self.page_size
+        self.page = page[:self.page_size]
+        return self.page
+
+    def get_paginated_response(self, data):
+        response = OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ])
+        if self.count is not None:
+            response['count'] = self.count
+        return Response(response)
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+            if size > 0:
+                return min(size, self.max_page_size)
+        except (KeyError, ValueError):
+            pass
+        return self.page_size
+
+    def get_sort_key(self, queryset):
+        ordering = queryset.query.order_by or queryset.model._meta.ordering
+        field = ordering[0] if ordering else '-id'
+        if not isinstance(field, str):
+            # expressions
+            field = '-id'
+        descending = field.startswith('-')
+        key = field.lstrip('-')
+        if key == 'pk' or not self.is_unique_path(queryset.model, key):
+            key = 'id'
+        return key, descending
+
+    def is_unique_path(self, model, key):
+        """ Checks the key is a non nullable, single valued field """
+        for name in key.split('__'):
+            if model is None:
+                return False
+            try:
+                field = model._meta.get_field(name)
+            except FieldDoesNotExist:
+                return False
+            if field.null or field.many_to_many or field.one_to_many:
+                return False
+            model = field.related_model
+        return True
+
+    def get_count(self, queryset, request):
+        mode = request.query_params.get(self.count_query_param, None)
+        if mode == 'exact':
+            return queryset.count()
+        if mode == 'approx':
+            connection = connections[queryset.db]
+            if connection.vendor != 'mysql':
+                return queryset.count()
+            sql, params = queryset.order_by().query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN ' + sql, params)
+                columns = [x[0] for x in cursor.description]
+                row = cursor.fetchone()
+            return int(row[columns.index('rows')] or 0) if row else 0
+        return None
+
+    def after(self, value, pk):
+        lookup = 'lt' if self.descending else 'gt'
+        if self.key == 'id':
+            return Q(**{'id__' + lookup: pk})
+        return Q(**{self.key + '__' + lookup: value}) | Q(
+            **{self.key: value, 'id__' + lookup: pk})
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param, '')
+        if not encoded:
+            return None
+        try:
+            value, pk = json.loads(
+                base64.urlsafe_b64decode(encoded.encode('ascii')).decode(
+                    'utf-8'))
+            return value, int(pk)
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, obj):
+        value = obj
+        for name in self.key.split('__'):
+            value = getattr(value, name)
+        if hasattr(value, 'pk'):
+            value = value.pk
+        if isinstance(value, date):
+            value = value.isoformat()
+        return base64.urlsafe_b64encode(
+            json.dumps([value, obj.pk]).encode('utf-8')).decode('ascii')
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param,
+                                   self.encode_cursor(self.page[-1]))
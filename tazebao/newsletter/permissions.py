@@ -1,6 +1,6 @@
 from rest_framework import permissions
 
-from newsletter.models import Dispatch
+from newsletter.models import MailerMessageDispatch
 
 
 class IsClient(permissions.BasePermission):
@@ -26,6 +26,6 @@ class IsMailerMessageClient(permissions.BasePermission):
 
     def has_object_permission(self, request, view, obj):
         if (request.user.is_authenticated):
-            return Dispatch.objects.filter(campaign__client__user=request.user,
-                                           id=obj.app).count() > 0
+            return MailerMessageDispatch.objects.filter(
+                message=obj, client__user=request.user).exists()
         return False
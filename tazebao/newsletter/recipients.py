@@ -0,0 +1,55 @@
+from django.conf import settings
+
+from .models import Subscriber
+
+
+class Recipients(object):
+    """ Distinct subscribers of a set of lists, ordered by id
+
+        A subscriber belonging to many lists is returned once. Iteration
+        reads chunk_size subscribers per query, moving on by id, so memory
+        stays flat regardless of the lists size (the MySQL driver buffers
+        whole result sets, so a single iterator() query would not).
+        first_id and last_id limit the recipients to an id range.
+    """
+
+    def __init__(self, lists_ids, first_id=None, last_id=None,
+                 chunk_size=None):
+        self.lists_ids = lists_ids
+        self.first_id = first_id
+        self.last_id = last_id
+        self.chunk_size = chunk_size or getattr(
+            settings, 'NEWSLETTER_RECIPIENTS_CHUNK_SIZE', 2000)
+
+    def queryset(self):
+        qs = Subscriber.objects.filter(
+            lists__id__in=self.lists_ids).distinct().order_by('id')
+        if self.first_id is not None:
+            qs = qs.filter(id__gte=self.first_id)
+        if self.last_id is not None:
+            qs = qs.filter(id__lte=self.last_id)
+        return qs
+
+    def count(self):
+        return self.queryset().count()
+
+    def ids(self):
+        """ Streams the recipients ids """
+        return self._chunks(
+            self.queryset().values_list('id', flat=True), lambda x: x)
+
+    def __iter__(self):
+        return self._chunks(
+            self.queryset().only('id', 'client', 'email',
+                                 'subscription_datetime'), lambda x: x.id)
+
+    def _chunks(self, qs, get_id):
+        last_id = None
+        while True:
+            chunk_qs = qs if last_id is None else qs.filter(id__gt=last_id)
+            chunk = list(chunk_qs[:self.chunk_size])
+            for item in chunk:
+                yield item
+            if len(chunk) < self.chunk_size:
+                return
+            last_id = get_id(chunk[-1])
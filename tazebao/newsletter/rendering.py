@@ -0,0 +1,387 @@
+import logging
+import re
+
+from django import template
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.signing import Signer
+from django.template import defaultfilters, smartif
+from django.template.base import (FilterExpression, Node, NodeList, Variable,
+                                  VariableNode, render_value_in_context)
+from django.template.library import SimpleNode
+from django.template.loader_tags import ExtendsNode, IncludeNode
+from django.urls import reverse
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
+
+from .context import get_campaign_context
+from .templatecache import compile_template
+from .templatetags.newsletter_tags import encrypt, link
+
+logger = logging.getLogger(__name__)
+
+# context key used by the newsletter tags to detect a plan compilation
+RENDER_PLAN_KEY = '_render_plan'
+
+SLOT_MARK = '\x1a'
+SLOT_RE = re.compile('\x1a(\\d+)\x1a')
+BODY_RE = re.compile(r'[^\$]*(</body>)[^\$]*', re.I)
+CLOSE_BODY_RE = re.compile(re.escape('</body>'), re.I)
+LINK_TAG_RE = re.compile(r'[^\$]*{% ?link[^\$]*?%}[^\$]*')
+
+TRACKING_IMAGE = '''
+                        <img src="%s" />
+                        '''
+
+# fake subscriber id used to split reversed urls into prefix and suffix
+URL_PLACEHOLDER = 987654321987654321
+
+PREVIEW_KEY = 'newsletter:preview:%s:%s'
+
+
+class SlotMarker(str):
+    """ Marker of a plan slot inside the compiled output
+
+        Escaping it (autoescape or escape filter) turns the slot into an
+        escaped one.
+    """
+
+    def __html__(self):
+        kind, arg, autoescape = self.plan.slots[self.index]
+        self.plan.slots[self.index] = (kind, arg, True)
+        return str.__str__(self)
+
+
+class SlotValue(object):
+    """ Stands for a subscriber variable while a plan is compiled
+
+        Printing it registers a slot in the plan and outputs its marker.
+    """
+
+    def __init__(self, plan, key):
+        self.plan = plan
+        self.key = key
+
+    def __str__(self):
+        return self.plan.add_slot('var', self.key)
+
+
+def _expressions(value):
+    """ Filter expressions held by a node attribute """
+    if isinstance(value, FilterExpression):
+        yield value
+    elif isinstance(value, (list, tuple)) and not isinstance(value, NodeList):
+        for item in value:
+            yield from _expressions(item)
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _expressions(item)
+    elif isinstance(value, smartif.TokenBase):
+        # if tag conditions
+        for attr in ('value', 'first', 'second'):
+            yield from _expressions(getattr(value, attr, None))
+
+
+def _plain_slot_use(node, expression):
+    """ Whether the subscriber variable of expression is just printed, or
+        passed to the encrypt and link tags, by node
+    """
+    if len(expression.var.lookups) > 1:
+        return False
+    if isinstance(node, VariableNode):
+        return all(
+            [func is defaultfilters.safe for func, args in expression.filters])
+    if isinstance(node, SimpleNode) and node.func in (encrypt, link):
+        return not expression.filters and expression in node.args
+    return False
+
+
+class CampaignRenderPlan(object):
+    """ Campaign templates compiled once per dispatch
+
+        Text, html and unsubscribe templates are rendered a single time with
+        placeholders in place of the subscriber variables and split into
+        static segments and slots. Site domain, urls prefixes and signers are
+        resolved up front, so rendering a message only costs slots
+        substitution and signing.
+        Templates using the subscriber variables other than printing them
+        or passing them to the encrypt and link tags (filters, lookups,
+        conditions...) are rendered in full for every message, since their
+        output depends on the values. The first rendered message is also
+        checked against a full render, falling back to full rendering for
+        the whole dispatch if they differ.
+    """
+
+    def __init__(self, campaign, dispatch):
+        self.campaign = campaign
+        self.dispatch = dispatch
+        self.client = campaign.client
+        self.topic = campaign.topic
+        self.domain = Site.objects.get_current().domain
+        self.signer = Signer()
+        self.subject = campaign.subject
+        self.from_header = "%s <%s>" % (
+            self.topic.sending_name,
+            self.topic.sending_address
+        )
+        self.view_online_url = ''.join([
+            'http://',
+            self.domain,
+            campaign.get_absolute_url()
+        ])
+        self.tracking_url = self._url_skeleton('newsletter-email-tracking')
+        self.click_url = self._url_skeleton('newsletter-click-tracking')
+        self.has_html = campaign.html_text is not None and campaign.html_text != u"" # noqa
+        self.open_tracking = False
+        self.click_tracking = bool(
+            self.has_html and LINK_TAG_RE.match(campaign.html_text))
+        # templates
+        self.unsubscribe_template = compile_template(
+            '{% load newsletter_tags %}' + (self.topic.unsubscribe_url or '')
+        )
+        self.text_template = compile_template(
+            '{% load newsletter_tags %}' + (campaign.plain_text or ''))
+        self.html_template = compile_template(
+            '{% load newsletter_tags %}' + campaign.html_text
+        ) if self.has_html else None
+        # compilation
+        self.slots = []
+        self.compiled = True
+        self.verified = False
+        self._contexts = {
+            True: template.Context(autoescape=True),
+            False: template.Context(autoescape=False),
+        }
+        self._check(self.unsubscribe_template,
+                    ('id', 'email', 'subscription_datetime'))
+        for tpl in (self.text_template, self.html_template):
+            self._check(tpl, ('unsubscribe_url', 'view_online_url',
+                              'subscriber_id', 'email'))
+        self.unsubscribe_parts = self._compile_unsubscribe() if self.topic.unsubscribe_url else None # noqa
+        self.text_parts = self._compile(self.text_template)
+        self.html_parts = self._compile_html() if self.has_html else None
+
+    def render(self, subscriber):
+        """ Returns the text and html contents for the given subscriber,
+            html content is None if the campaign has no html text
+        """
+        if not self.compiled:
+            return self._render_full(subscriber)
+        contents = self._render_compiled(subscriber)
+        if not self.verified:
+            self.verified = True
+            full_contents = self._render_full(subscriber)
+            if contents != full_contents:
+                logger.info(
+                    'campaign %s cannot be compiled, falling back to full rendering' % self.campaign.pk) # noqa
+                self.compiled = False
+                return full_contents
+        return contents
+
+    def add_slot(self, kind, arg):
+        """ Registers a slot and returns its marker """
+        self.slots.append((kind, arg, False))
+        marker = SlotMarker('%s%d%s' % (SLOT_MARK, len(self.slots) - 1, SLOT_MARK)) # noqa
+        marker.plan = self
+        marker.index = len(self.slots) - 1
+        return marker
+
+    def has_slots(self, args):
+        return any([isinstance(x, SlotValue) for x in args])
+
+    def encrypt_slot(self, args):
+        return self.add_slot('encrypt', args)
+
+    def link_slot(self, url):
+        if not isinstance(url, str) or SLOT_MARK in url:
+            self.compiled = False
+            return ''
+        return self.add_slot('link', url)
+
+    def tracking_image(self, subscriber_id):
+        s = self.signer.sign('%s-%s' % (str(self.dispatch.id), str(subscriber_id))).split(':')[1] # noqa
+        head, tail = self.tracking_url
+        return TRACKING_IMAGE % ''.join([head, str(subscriber_id), tail, '?s=' + s]) # noqa
+
+    def link_url(self, subscriber_id, url):
+        s = self.signer.sign('%s-%s-%s' % (str(self.dispatch.id),
+                                           str(subscriber_id), url)).rsplit(
+                                               ':', 1)[1]
+        head, tail = self.click_url
+        return ''.join([head, str(subscriber_id), tail, '?url=' + url, '&s=' + s]) # noqa
+
+    def subscriber_view_online_url(self, subscriber_id):
+        sig = encrypt({'client': self.client}, str(subscriber_id) + str(self.dispatch.id)) # noqa
+        return self.view_online_url + '?subscriber=%s&dispatch=%s&sig=%s' % (
+            subscriber_id,
+            self.dispatch.id,
+            sig
+        )
+
+    def _url_skeleton(self, name):
+        url = reverse(name, kwargs={
+            'dispatch_id': self.dispatch.id,
+            'subscriber_id': URL_PLACEHOLDER
+        })
+        head, tail = url.split(str(URL_PLACEHOLDER))
+        return 'http://' + self.domain + head, tail
+
+    def _check(self, tpl, names):
+        """ Disables the compilation if tpl uses the subscriber variables
+            names other than plainly
+        """
+        if tpl is None:
+            return
+        for node in tpl.nodelist.get_nodes_by_type(Node):
+            if isinstance(node, (ExtendsNode, IncludeNode)):
+                # other templates nodes are not inspected
+                self.compiled = False
+            for expression in _expressions(list(node.__dict__.values())):
+                if isinstance(expression.var, Variable) and \
+                        expression.var.lookups and \
+                        expression.var.lookups[0] in names and \
+                        not _plain_slot_use(node, expression):
+                    self.compiled = False
+
+    def _compile_context(self, variables):
+        context = template.Context()
+        context.update(variables)
+        context.update({RENDER_PLAN_KEY: self})
+        return context
+
+    def _main_context(self):
+        context = {'client': self.client}
+        context.update(get_campaign_context(self.campaign))
+        context.update({
+            'unsubscribe_url': SlotValue(self, 'unsubscribe_url'),
+            'view_online_url': SlotValue(self, 'view_online_url'),
+            'subscriber_id': SlotValue(self, 'subscriber_id'),
+            'email': SlotValue(self, 'email'),
+            'dispatch_id': self.dispatch.id,
+        })
+        return self._compile_context(context)
+
+    def _compile_unsubscribe(self):
+        context = self._compile_context({
+            'client': self.client,
+            'id': SlotValue(self, 'subscriber_id'),
+            'email': SlotValue(self, 'email'),
+            'subscription_datetime': SlotValue(self, 'subscription_datetime'),
+        })
+        return self._split(self.unsubscribe_template.render(context))
+
+    def _compile(self, tpl):
+        return self._split(tpl.render(self._main_context()))
+
+    def _compile_html(self):
+        html_content = self.html_template.render(self._main_context())
+        # add tracking image
+        matches = BODY_RE.match(html_content)
+        if matches:
+            marker = self.add_slot('image', None)
+            html_content = CLOSE_BODY_RE.sub(marker + matches.group(1), html_content) # noqa
+            self.open_tracking = True
+        return self._split(html_content)
+
+    def _split(self, rendered):
+        parts = []
+        for index, bit in enumerate(SLOT_RE.split(rendered)):
+            if index % 2:
+                parts.append(int(bit))
+            elif SLOT_MARK in bit:
+                # a marker was mangled by some filter
+                self.compiled = False
+            elif bit:
+                parts.append(bit)
+        return parts
+
+    def _join(self, parts, values):
+        return ''.join([
+            self._slot_value(self.slots[part], values)
+            if isinstance(part, int) else part for part in parts
+        ])
+
+    def _slot_value(self, slot, values):
+        kind, arg, autoescape = slot
+        if kind == 'var':
+            return render_value_in_context(values[arg],
+                                           self._contexts[autoescape])
+        if kind == 'encrypt':
+            value = encrypt({'client': self.client}, *[
+                values[a.key] if isinstance(a, SlotValue) else a for a in arg
+            ])
+        elif kind == 'link':
+            value = self.link_url(values['subscriber_id'], arg)
+        else:
+            value = self.tracking_image(values['subscriber_id'])
+        return conditional_escape(value) if autoescape else value
+
+    def _render_compiled(self, subscriber):
+        values = {
+            'subscriber_id': subscriber.id,
+            'email': subscriber.email,
+            'subscription_datetime': subscriber.subscription_datetime,
+            'unsubscribe_url': '',
+            'view_online_url': self.subscriber_view_online_url(subscriber.id),
+        }
+        if self.unsubscribe_parts is not None:
+            values['unsubscribe_url'] = mark_safe(
+                self._join(self.unsubscribe_parts, values))
+        text_content = self._join(self.text_parts, values)
+        html_content = None
+        if self.html_parts is not None:
+            html_content = self._join(self.html_parts, values)
+        return text_content, html_content
+
+    def _render_full(self, subscriber):
+        # unsubscribe text
+        unsubscribe_url = ''
+        if self.topic.unsubscribe_url:
+            ctx = template.Context()
+            ctx.update({'client': self.client})
+            ctx.update({'id': subscriber.id})
+            ctx.update({'email': subscriber.email})
+            ctx.update({'subscription_datetime': subscriber.subscription_datetime}) # noqa
+            unsubscribe_url = self.unsubscribe_template.render(ctx)
+        # subject and body
+        context = template.Context()
+        context.update({'client': self.client})
+        context.update({'unsubscribe_url': unsubscribe_url})
+        context.update(get_campaign_context(self.campaign))
+        context.update({'view_online_url': self.subscriber_view_online_url(subscriber.id)}) # noqa
+        context.update({'subscriber_id': subscriber.id})
+        context.update({'email': subscriber.email})
+        context.update({'dispatch_id': self.dispatch.id})
+        text_content = self.text_template.render(context)
+        html_content = None
+        if self.has_html:
+            html_content = self.html_template.render(context)
+            # add tracking image
+            matches = BODY_RE.match(html_content)
+            if matches:
+                tracking_image = self.tracking_image(subscriber.id)
+                html_content = CLOSE_BODY_RE.sub(tracking_image + matches.group(1), html_content) # noqa
+                self.open_tracking = True
+        return text_content, html_content
+
+
+def render_preview(campaign):
+    """ Returns the plain text and html of a campaign rendered without
+        subscriber, cached per campaign and last edit datetime so that an
+        edit makes a new render
+    """
+    key = PREVIEW_KEY % (campaign.pk,
+                         campaign.last_edit_datetime.isoformat())
+    preview = cache.get(key)
+    if preview is None:
+        preview = {}
+        for field in ('plain_text', 'html_text'):
+            tpl = compile_template('{% load newsletter_tags %}' +
+                                   (getattr(campaign, field) or ''))
+            context = template.Context({})
+            context.update(get_campaign_context(campaign))
+            preview[field] = tpl.render(context)
+        cache.set(key, preview,
+                  getattr(settings, 'NEWSLETTER_PREVIEW_CACHE_TIMEOUT', 86400))
+    return preview
@@ -1,12 +1,14 @@
-from django import template
+import json
+
 from django.contrib.sites.models import Site
 from django.urls import reverse
 from rest_framework import serializers
 from mailqueue.models import MailerMessage
 
-from .context import get_campaign_context
-from .models import (Campaign, Dispatch, FailedEmail, Planning, Subscriber,
-                     SubscriberList, SubscriptionForm, SystemMessage, Topic, Tracking)
+from .models import (Campaign, DailyStats, Dispatch, DispatchStats,
+                     FailedEmail, ImportJob, Planning, Subscriber, SubscriberList,
+                     SubscriptionForm, SystemMessage, Topic, Tracking)
+from .rendering import render_preview
 
 
 class ClientFilteredPrimaryKeyRelatedField(
@@ -34,6 +36,9 @@ class SubscriberListSerializer(serializers.ModelSerializer):
         read_only_fields = ('client', )
 
     def tot_subscribers_fn(self, obj):
+        # annotated by the lists queryset
+        if hasattr(obj, 'tot_subscribers'):
+            return obj.tot_subscribers
         return obj.subscriber_set.count()
 
 
@@ -98,18 +103,10 @@ class CampaignSerializer(serializers.ModelSerializer):
         return obj.topic.id
 
     def plain_text_fn(self, obj):
-        tpl = template.Template(
-            '{% load newsletter_tags %}' + obj.plain_text)  # noqa
-        context = template.Context({})
-        context.update(get_campaign_context(obj))
-        return tpl.render(context)
+        return render_preview(obj)['plain_text']
 
     def html_text_fn(self, obj):
-        tpl = template.Template(
-            '{% load newsletter_tags %}' + obj.html_text)  # noqa
-        context = template.Context({})
-        context.update(get_campaign_context(obj))
-        return tpl.render(context)
+        return render_preview(obj)['html_text']
 
     def url_fn(self, obj):
         return ''.join([
@@ -119,6 +116,9 @@ class CampaignSerializer(serializers.ModelSerializer):
         ])
 
     def last_dispatch_fn(self, obj):
+        # annotated by the campaigns queryset
+        if hasattr(obj, 'last_dispatch_datetime'):
+            return obj.last_dispatch_datetime
         last = obj.dispatch_set.last()
         if last:
             return last.started_at
@@ -126,6 +126,8 @@ class CampaignSerializer(serializers.ModelSerializer):
             return None
 
     def last_not_test_dispatch_fn(self, obj):
+        if hasattr(obj, 'last_not_test_dispatch_datetime'):
+            return obj.last_not_test_dispatch_datetime
         last = obj.dispatch_set.filter(test=False).last()
         if last:
             return last.started_at
@@ -133,6 +135,16 @@ class CampaignSerializer(serializers.ModelSerializer):
             return None
 
 
+class CampaignSummarySerializer(CampaignSerializer):
+    """ Campaign Serializer without the rendered texts, used in lists """
+
+    class Meta(CampaignSerializer.Meta):
+        fields = tuple([
+            x for x in CampaignSerializer.Meta.fields
+            if x not in ('plain_text', 'html_text')
+        ])
+
+
 class FailedEmailSerializer(serializers.ModelSerializer):
     """ Tracking Serializer """
     subscriber_email = serializers.SerializerMethodField("subscriber_email_fn")
@@ -157,7 +169,7 @@ class FailedEmailSerializer(serializers.ModelSerializer):
         return obj.subscriber.email
 
     def subscriber_id_fn(self, obj):
-        return obj.subscriber.id
+        return obj.subscriber_id
 
     def campaign_name_fn(self, obj):
         if obj.dispatch:
@@ -192,7 +204,7 @@ class DispatchSerializer(serializers.ModelSerializer):
     trackings = TrackingSerializer(many=True, read_only=True)
     bounces = FailedEmailSerializer(many=True, read_only=True)
     campaign_name = serializers.SerializerMethodField("campaign_name_fn")
-    queryset = Dispatch.objects.all().select_related('campaign')
+    queryset = Dispatch.objects.all().select_related('campaign', 'stats')
 
     class Meta:
         model = Dispatch
@@ -221,6 +233,78 @@ class DispatchSerializer(serializers.ModelSerializer):
         return obj.campaign.name
 
 
+class DispatchStatsSerializer(serializers.ModelSerializer):
+    """ DispatchStats Serializer """
+
+    class Meta:
+        model = DispatchStats
+        fields = (
+            'unique_opens',
+            'total_opens',
+            'unique_clickers',
+            'total_clicks',
+            'bounces',
+        )
+
+
+class DispatchSummarySerializer(serializers.ModelSerializer):
+    """ Dispatch Serializer without trackings and bounces, only their
+        counters and rates
+    """
+    campaign_name = serializers.SerializerMethodField("campaign_name_fn")
+    stats = DispatchStatsSerializer(source='get_stats', read_only=True)
+
+    class Meta:
+        model = Dispatch
+        fields = (
+            'id',
+            'campaign',
+            'campaign_name',
+            'test',
+            'lists',
+            'started_at',
+            'finished_at',
+            'error',
+            'error_message',
+            'success',
+            'open_statistics',
+            'click_statistics',
+            'sent',
+            'error_recipients',
+            'open_rate',
+            'click_rate',
+            'stats',
+        )
+
+    def campaign_name_fn(self, obj):
+        return obj.campaign.name
+
+
+class ImportJobSerializer(serializers.ModelSerializer):
+    """ ImportJob Serializer """
+    errors = serializers.SerializerMethodField("errors_fn")
+
+    class Meta:
+        model = ImportJob
+        fields = (
+            'id',
+            'lists',
+            'created',
+            'started_at',
+            'finished_at',
+            'phase',
+            'processed',
+            'inserted',
+            'updated',
+            'rejected',
+            'errors',
+            'error_message',
+        )
+
+    def errors_fn(self, obj):
+        return json.loads(obj.errors) if obj.errors else []
+
+
 class PlanningSerializer(serializers.ModelSerializer):
     """ Planning Serializer """
     campaign_name = serializers.SerializerMethodField("campaign_name_fn")
@@ -278,6 +362,20 @@ class UnsubscriptionStatsSerializer(serializers.Serializer):
     datetime__date = serializers.DateField()
     cnt = serializers.IntegerField()
 
+class DailyStatsSerializer(serializers.ModelSerializer):
+    """ DailyStats Serializer """
+    net = serializers.ReadOnlyField()
+
+    class Meta:
+        model = DailyStats
+        fields = (
+            'date',
+            'subscriptions',
+            'unsubscriptions',
+            'net',
+            'bounces',
+        )
+
 class SubscriptionFormSerializer(serializers.ModelSerializer):
     """ SubscribtionForm Serializer """
     standalone_link = serializers.SerializerMethodField("standalone_link_fn")
@@ -0,0 +1,62 @@
+from datetime import date, datetime
+
+from dateutil.relativedelta import relativedelta
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import (Client, Dispatch, FailedEmail, MailerMessageDispatch,
+                     Planning, Subscriber, Unsubscription)
+from .serializers import DispatchSummarySerializer, PlanningSerializer
+
+
+def _count(queryset):
+    """ Correlated subquery counting the queryset rows of the outer client """
+    return Coalesce(
+        Subquery(
+            queryset.filter(client=OuterRef('pk')).order_by().values(
+                'client').annotate(count=Count('*')).values('count'),
+            output_field=IntegerField()), 0)
+
+
+def dashboard_stats(user):
+    """ Dashboard counters of the client of a user
+
+        All the counters are read in a single query of correlated
+        subqueries, the last dispatch and the next planning in one query
+        each (plus their lists).
+    """
+    last_month = date.today() - relativedelta(months=1)
+    counters = Client.objects.filter(user=user).annotate(
+        subscribers=_count(Subscriber.objects.all()),
+        last_month_subscribers=_count(
+            Subscriber.objects.filter(subscription_datetime__gte=last_month)),
+        last_month_unsubscriptions=_count(
+            Unsubscription.objects.filter(datetime__gte=last_month)),
+        bounces=_count(FailedEmail.objects.all()),
+        dispatching=_count(
+            MailerMessageDispatch.objects.filter(message__sent=False)),
+    ).values('subscribers', 'last_month_subscribers',
+             'last_month_unsubscriptions', 'bounces', 'dispatching').first()
+    if counters is None:
+        counters = dict.fromkeys(
+            ['subscribers', 'last_month_subscribers',
+             'last_month_unsubscriptions', 'bounces', 'dispatching'], 0)
+    last_dispatch = Dispatch.objects.filter(
+        campaign__client__user=user, test=False).select_related(
+            'campaign', 'stats').prefetch_related('lists').order_by(
+                '-id').first()
+    next_planning = Planning.objects.filter(
+        campaign__client__user=user,
+        schedule__gte=datetime.now()).select_related(
+            'campaign').prefetch_related('lists').order_by('schedule').first()
+    return {
+        'subscribers': counters['subscribers'],
+        'bounces': counters['bounces'],
+        'dispatching': counters['dispatching'],
+        'lastMonthUnsubscriptions': counters['last_month_unsubscriptions'],
+        'lastMonthSubscribers': counters['last_month_subscribers'],
+        'lastDispatch': DispatchSummarySerializer(last_dispatch).data
+        if last_dispatch else None,
+        'nextPlanning': PlanningSerializer(next_planning).data
+        if next_planning else None,
+    }
@@ -1,12 +1,13 @@
 from __future__ import absolute_import
-import re
 
-from django import template
+import json
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
 from django.utils import timezone
-from django.template import Context
-from django.urls import reverse
-from django.contrib.sites.models import Site
-from django.core.signing import Signer
 from django.core.mail import EmailMultiAlternatives
 
 from core.celery import app
@@ -14,8 +15,14 @@ from celery.utils.log import get_task_logger
 
 from mailqueue.models import MailerMessage
 
-from .models import Dispatch, SubscriberList, Campaign
-from .context import get_campaign_context
+from .bulk import delete_subscribers
+from .enqueue import CheckpointError, MessageEnqueuer
+from .importing import SubscribersImport
+from .models import (Campaign, Dispatch, DispatchShard, ImportJob,
+                     SubscriberList)
+from .recipients import Recipients
+from .rendering import CampaignRenderPlan
+from .tracking import ingest_events
 
 import logging
 
@@ -46,83 +53,28 @@ def test_campaign(lists_ids, campaign_id):
         # send params
         error_addresses = []
         sent_addresses = []
-        # templates
-        unsubscribe_url_template = template.Template(
-            '{% load newsletter_tags %}' + ('' if campaign.topic.unsubscribe_url is None else campaign.topic.unsubscribe_url) # noqa
-        )
-        text_template = template.Template('{% load newsletter_tags %}' + campaign.plain_text) # noqa
-        html_template = template.Template('{% load newsletter_tags %}' + campaign.html_text) # noqa
-        # email from header
-        from_header = "%s <%s>" % (
-            campaign.topic.sending_name,
-            campaign.topic.sending_address
-        )
-        for subscriber_list in lists_obj:
-            for subscriber in subscriber_list.subscriber_set.all():
-                # unsubscribe text
-                unsubscribe_url = ''
-                if campaign.topic.unsubscribe_url:
-                    ctx = Context()
-                    ctx.update({'client': campaign.client})
-                    ctx.update({'id': subscriber.id})
-                    ctx.update({'email': subscriber.email})
-                    ctx.update({'subscription_datetime': subscriber.subscription_datetime}) # noqa
-                    unsubscribe_url = unsubscribe_url_template.render(ctx)
-                # subject and body
-                context = Context()
-                context.update({'client': campaign.client})
-                context.update({'unsubscribe_url': unsubscribe_url})
-                context.update(get_campaign_context(campaign, subscriber, dispatch)) # noqa
-                context.update({'subscriber_id': subscriber.id})
-                context.update({'email': subscriber.email})
-                context.update({'subscriber_id': subscriber.id})
-                context.update({'dispatch_id': dispatch.id})
-                msg = EmailMultiAlternatives(
-                        campaign.subject,
-                        text_template.render(context),
-                        from_header,
-                        [subscriber.email]
-                        )
-                open_tracking = False
-                click_tracking = False
-                if campaign.html_text is not None and campaign.html_text != u"": # noqa
-                    html_content = html_template.render(context)
-                    # add tracking image
-                    matches = re.match(r'[^\$]*(</body>)[^\$]*', html_content, re.I) # noqa
-                    if matches:
-                        signer = Signer()
-                        s = signer.sign('%s-%s' % (str(dispatch.id), str(subscriber.id))).split(':')[1] # noqa
-                        current_site = Site.objects.get_current()
-                        tracking_image = '''
-                        <img src="%s" />
-                        ''' % ''.join([
-                            'http://',
-                            current_site.domain,
-                            reverse('newsletter-email-tracking',
-                                    kwargs={
-                                        'dispatch_id': dispatch.id,
-                                        'subscriber_id': subscriber.id
-                                    }),
-                            '?s=' + s
-                        ])
-                        rexp = re.compile(re.escape('</body>'), re.I)
-                        html_content = rexp.sub(tracking_image + matches.group(1), html_content) # noqa
-                        open_tracking = True
-
-                    if re.match('[^\$]*{% ?link[^\$]*?%}[^\$]*', campaign.html_text): # noqa
-                        click_tracking = True
-
-                    msg.attach_alternative(html_content, "text/html")
-                try:
-                    msg.send()
-                    sent_addresses.append(subscriber.email)
-                    sent += 1
-                except:
-                    error_addresses.append(subscriber.email)
+        # templates and urls are compiled once for the whole dispatch
+        plan = CampaignRenderPlan(campaign, dispatch)
+        for subscriber in Recipients(lists_ids):
+            text_content, html_content = plan.render(subscriber)
+            msg = EmailMultiAlternatives(
+                    plan.subject,
+                    text_content,
+                    plan.from_header,
+                    [subscriber.email]
+                    )
+            if html_content is not None:
+                msg.attach_alternative(html_content, "text/html")
+            try:
+                msg.send()
+                sent_addresses.append(subscriber.email)
+                sent += 1
+            except:
+                error_addresses.append(subscriber.email)
         dispatch.error = False
         dispatch.success = True
-        dispatch.open_statistics = open_tracking
-        dispatch.click_statistics = click_tracking
+        dispatch.open_statistics = plan.open_tracking
+        dispatch.click_statistics = plan.click_tracking
         dispatch.finished_at = timezone.now()
         dispatch.sent = sent
         dispatch.error_recipients = ','.join(error_addresses)
@@ -137,9 +89,166 @@ def test_campaign(lists_ids, campaign_id):
     return sent
 
 
+def _enqueue_subscribers(plan, enqueuer, subscribers):
+    """ Renders and enqueues the messages for the given subscribers """
+    for subscriber in subscribers:
+        text_content, html_content = plan.render(subscriber)
+        msg = MailerMessage()
+        msg.app = plan.dispatch.pk
+        msg.subject = plan.subject
+        msg.to_address = subscriber.email
+        msg.from_address = plan.from_header
+        msg.content = text_content
+        if html_content is not None:
+            msg.html_content = html_content
+        enqueuer.add(msg, subscriber.id)
+    enqueuer.flush()
+
+
+def _subscriber_shards(lists_ids, shard_size):
+    """ Splits the subscribers of the given lists in id ranges
+        of shard_size subscribers, returns (first id, last id, count) tuples
+    """
+    shards = []
+    first = None
+    count = 0
+    for subscriber_id in Recipients(lists_ids).ids():
+        if first is None:
+            first = subscriber_id
+        last = subscriber_id
+        count += 1
+        if count == shard_size:
+            shards.append((first, last, count))
+            first = None
+            count = 0
+    if first is not None:
+        shards.append((first, last, count))
+    return shards
+
+
+def _finalize_dispatch(dispatch_id):
+    """ Closes the dispatch once all its shards are done """
+    with transaction.atomic():
+        dispatch = Dispatch.objects.select_for_update().get(pk=dispatch_id)
+        shards = list(dispatch.shards.all())
+        if dispatch.finished_at is not None or not all(
+                [shard.done for shard in shards]):
+            return
+        dispatch.success = not dispatch.error
+        dispatch.finished_at = timezone.now()
+        dispatch.sent = sum([shard.sent for shard in shards])
+        dispatch.error_recipients = ','.join([
+            shard.error_recipients for shard in shards
+            if shard.error_recipients
+        ])
+        dispatch.save()
+
+
+class ShardLeaseLost(CheckpointError):
+    """ The shard lease expired and another worker claimed it """
+
+
+class ShardFailed(Exception):
+    """ The shard failed and was released to be retried """
+
+
+def _shard_lease():
+    return timedelta(
+        seconds=getattr(settings, 'NEWSLETTER_SHARD_LEASE', 300))
+
+
+def _shard_retry_delay(attempts):
+    """ Seconds before retrying a shard failed attempts times """
+    return getattr(settings, 'NEWSLETTER_SHARD_RETRY_DELAY', 60) * attempts
+
+
+def _claim_shard(shard_id):
+    """ Leases the shard to the calling worker, returns the lease token, or
+        None if the shard is done or leased to another worker
+    """
+    token = uuid.uuid4().hex
+    now = timezone.now()
+    claimed = DispatchShard.objects.filter(pk=shard_id, done=False).filter(
+        Q(claimed_until__isnull=True) | Q(claimed_until__lt=now)).update(
+            claimed_by=token,
+            claimed_until=now + _shard_lease(),
+            attempts=F('attempts') + 1,
+            updated_at=now)
+    return token if claimed else None
+
+
+def _run_shard(shard, token, plan=None):
+    """ Renders and enqueues the shard messages, starting after its
+        checkpoint if the shard was already partially sent
+
+        The shard must be leased with token, every checkpoint renews the
+        lease and stops the shard if it was lost. A failing shard is
+        released and ShardFailed is raised, after
+        NEWSLETTER_SHARD_MAX_ATTEMPTS attempts the shard is closed with an
+        error instead.
+    """
+    dispatch = shard.dispatch
+    lease = _shard_lease()
+
+    def checkpoint(subscriber_id, sent, error_addresses):
+        # runs in the same transaction which writes the messages
+        error_recipients = ','.join(
+            [x for x in [shard.error_recipients] + error_addresses if x])
+        now = timezone.now()
+        if not DispatchShard.objects.filter(
+                pk=shard.pk, claimed_by=token).update(
+                    checkpoint=subscriber_id,
+                    sent=shard.sent + sent,
+                    error_recipients=error_recipients,
+                    claimed_until=now + lease,
+                    updated_at=now):
+            raise ShardLeaseLost('shard %s lease lost' % shard)
+        shard.checkpoint = subscriber_id
+        shard.sent += sent
+        shard.error_recipients = error_recipients
+
+    enqueuer = MessageEnqueuer(dispatch, checkpoint=checkpoint)
+    try:
+        if plan is None:
+            plan = CampaignRenderPlan(dispatch.campaign, dispatch)
+        first_id = shard.first_subscriber_id
+        if shard.checkpoint is not None:
+            first_id = shard.checkpoint + 1
+        recipients = Recipients(
+            [x.pk for x in dispatch.lists.all()],
+            first_id=first_id,
+            last_id=shard.last_subscriber_id)
+        _enqueue_subscribers(plan, enqueuer, recipients)
+    except ShardLeaseLost as e:
+        # the new owner goes on from the last checkpoint
+        logger.warning(str(e))
+        return enqueuer.sent
+    except Exception as e:
+        if shard.attempts < getattr(settings, 'NEWSLETTER_SHARD_MAX_ATTEMPTS',
+                                    3):
+            Dispatch.objects.filter(pk=dispatch.pk).update(
+                error_message=str(e))
+            DispatchShard.objects.filter(
+                pk=shard.pk, claimed_by=token).update(
+                    claimed_until=None, updated_at=timezone.now())
+            raise ShardFailed(str(e))
+        Dispatch.objects.filter(pk=dispatch.pk).update(
+            error=True, error_message=str(e))
+    DispatchShard.objects.filter(pk=shard.pk, claimed_by=token).update(
+        done=True, claimed_until=None, updated_at=timezone.now())
+    _finalize_dispatch(dispatch.pk)
+
+    return enqueuer.sent
+
+
 @app.task # noqa
 def send_campaign(lists_ids, campaign_id, test=False):
-    """ Dispatches the newsletter """
+    """ Dispatches the newsletter
+
+        Returns the number of enqueued messages when the dispatch has a
+        single shard, otherwise the number of recipients handed to the
+        shard tasks, which enqueue their messages asynchronously.
+    """
     logger.debug('running task: send_newsletter')
     campaign = Campaign.objects.get(pk=campaign_id)
     logger.debug('sending campaign: %s' % campaign)
@@ -152,99 +261,144 @@ def send_campaign(lists_ids, campaign_id, test=False):
         test=test
     )
     dispatch.save()
-    sent = 0
+    recipients = 0
     try:
         lists_obj = [SubscriberList.objects.get(pk=x) for x in lists_ids]
         dispatch.lists.set(lists_obj)
+        # templates and urls are compiled once for the whole dispatch
+        plan = CampaignRenderPlan(campaign, dispatch)
+        dispatch.open_statistics = plan.open_tracking
+        dispatch.click_statistics = plan.click_tracking
         dispatch.save()
-        # send params
-        error_addresses = []
-        sent_addresses = []
-        # templates
-        unsubscribe_url_template = template.Template(
-            '{% load newsletter_tags %}' + ('' if campaign.topic.unsubscribe_url is None else campaign.topic.unsubscribe_url) # noqa
-        )
-        text_template = template.Template('{% load newsletter_tags %}' + campaign.plain_text) # noqa
-        html_template = template.Template('{% load newsletter_tags %}' + campaign.html_text) # noqa
-        # email from header
-        from_header = "%s <%s>" % (
-            campaign.topic.sending_name,
-            campaign.topic.sending_address
-        )
-        for subscriber_list in lists_obj:
-            for subscriber in subscriber_list.subscriber_set.all():
-                msg = MailerMessage()
-                # unsubscribe text
-                unsubscribe_url = ''
-                if campaign.topic.unsubscribe_url:
-                    ctx = Context()
-                    ctx.update({'client': campaign.client})
-                    ctx.update({'id': subscriber.id})
-                    ctx.update({'email': subscriber.email})
-                    ctx.update({'subscription_datetime': subscriber.subscription_datetime}) # noqa
-                    unsubscribe_url = unsubscribe_url_template.render(ctx)
-                # subject and body
-                context = Context()
-                context.update({'client': campaign.client})
-                context.update({'unsubscribe_url': unsubscribe_url})
-                context.update(get_campaign_context(campaign, subscriber, dispatch)) # noqa
-                context.update({'subscriber_id': subscriber.id})
-                context.update({'email': subscriber.email})
-                context.update({'subscriber_id': subscriber.id})
-                context.update({'dispatch_id': dispatch.id})
-                msg.app = dispatch.pk
-                msg.subject = campaign.subject
-                msg.to_address = subscriber.email
-                msg.from_address = from_header
-                msg.content = text_template.render(context)
-                open_tracking = False
-                click_tracking = False
-                if campaign.html_text is not None and campaign.html_text != u"": # noqa
-                    html_content = html_template.render(context)
-                    # add tracking image
-                    matches = re.match(r'[^\$]*(</body>)[^\$]*', html_content, re.I) # noqa
-                    if matches:
-                        signer = Signer()
-                        s = signer.sign('%s-%s' % (str(dispatch.id), str(subscriber.id))).split(':')[1] # noqa
-                        current_site = Site.objects.get_current()
-                        tracking_image = '''
-                        <img src="%s" />
-                        ''' % ''.join([
-                            'http://',
-                            current_site.domain,
-                            reverse('newsletter-email-tracking',
-                                    kwargs={
-                                        'dispatch_id': dispatch.id,
-                                        'subscriber_id': subscriber.id
-                                    }),
-                            '?s=' + s
-                        ])
-                        rexp = re.compile(re.escape('</body>'), re.I)
-                        html_content = rexp.sub(tracking_image + matches.group(1), html_content) # noqa
-                        open_tracking = True
-
-                    if re.match('[^\$]*{% ?link[^\$]*?%}[^\$]*', campaign.html_text): # noqa
-                        click_tracking = True
-                    msg.html_content = html_content
-                try:
-                    msg.save()
-                    sent_addresses.append(subscriber.email)
-                    sent += 1
-                except:
-                    error_addresses.append(subscriber.email)
-        dispatch.error = False
-        dispatch.success = True
-        dispatch.open_statistics = open_tracking
-        dispatch.click_statistics = click_tracking
-        dispatch.finished_at = timezone.now()
-        dispatch.sent = sent
-        dispatch.error_recipients = ','.join(error_addresses)
-        dispatch.save()
-        # log_email_file.debug("\n".join(sent_addresses))
+        # all shards must exist before the first one can finish
+        shards = []
+        with transaction.atomic():
+            for first, last, count in _subscriber_shards(
+                    lists_ids,
+                    getattr(settings, 'NEWSLETTER_DISPATCH_SHARD_SIZE', 5000)): # noqa
+                shard = DispatchShard(
+                    dispatch=dispatch,
+                    first_subscriber_id=first,
+                    last_subscriber_id=last)
+                shard.save()
+                shards.append(shard)
+                recipients += count
+        logger.debug('dispatch %s: %d shards' % (dispatch.pk, len(shards)))
+        if len(shards) == 1:
+            # no need to fan out
+            token = _claim_shard(shards[0].pk)
+            shards[0].refresh_from_db()
+            try:
+                return _run_shard(shards[0], token, plan)
+            except ShardFailed:
+                send_campaign_shard.apply_async(
+                    (shards[0].pk, ), countdown=_shard_retry_delay(1))
+                return 0
+        # fan out, the last shard task closes the dispatch
+        for shard in shards:
+            send_campaign_shard.delay(shard.pk)
+        if not shards:
+            _finalize_dispatch(dispatch.pk)
     except Exception as e:
         dispatch.error = True
         dispatch.error_message = str(e)
         dispatch.success = False
         dispatch.save()
+        return 0
 
-    return sent
+    return recipients
+
+
+@app.task(bind=True, acks_late=True, max_retries=None) # noqa
+def send_campaign_shard(self, shard_id):
+    """ Dispatches the newsletter to the subscribers of a shard
+
+        Acknowledged late, so that a shard lost in a worker restart is
+        delivered again and resumed from its checkpoint. The shard is
+        leased: a task finding it leased, to a running worker or to one
+        which died, is retried when the lease expires, a failing shard is
+        retried after NEWSLETTER_SHARD_RETRY_DELAY seconds per attempt.
+    """
+    token = _claim_shard(shard_id)
+    if token is None:
+        shard = DispatchShard.objects.filter(pk=shard_id,
+                                             done=False).first()
+        if shard is None:
+            return 0
+        countdown = 1
+        if shard.claimed_until is not None:
+            countdown += max(
+                (shard.claimed_until - timezone.now()).total_seconds(), 0)
+        raise self.retry(countdown=countdown)
+    shard = DispatchShard.objects.select_related('dispatch__campaign').get(
+        pk=shard_id)
+    logger.debug('sending dispatch %s shard %s' % (shard.dispatch_id, shard))
+    try:
+        return _run_shard(shard, token)
+    except ShardFailed as e:
+        raise self.retry(exc=e, countdown=_shard_retry_delay(shard.attempts))
+
+
+@app.task # noqa
+def resume_dispatch(dispatch_id, stale=15):
+    """ Resumes the stale shards of a dispatch from their checkpoints """
+    logger.debug('resuming dispatch %s' % dispatch_id)
+    for shard_id in DispatchShard.stale(stale).filter(
+            dispatch__id=dispatch_id).values_list('pk', flat=True):
+        send_campaign_shard.delay(shard_id)
+    _finalize_dispatch(dispatch_id)
+
+
+@app.task # noqa
+def ingest_tracking_events():
+    """ Stores the buffered open and click events """
+    created = ingest_events()
+    logger.debug('stored %d tracking events' % created)
+    return created
+
+
+@app.task # noqa
+def import_subscribers(job_id):
+    """ Runs a subscribers csv import job """
+    job = ImportJob.objects.select_related('client').get(pk=job_id)
+    ImportJob.objects.filter(pk=job.pk).update(
+        phase=ImportJob.RUNNING, started_at=timezone.now())
+
+    def progress(subscribers_import):
+        ImportJob.objects.filter(pk=job.pk).update(
+            processed=subscribers_import.processed,
+            inserted=subscribers_import.inserted,
+            updated=subscribers_import.existing,
+            rejected=subscribers_import.rejected)
+
+    subscribers_import = None
+    values = {}
+    try:
+        subscribers_import = SubscribersImport(
+            job.client, [x.pk for x in job.lists.all()], progress=progress)
+        with job.file.open('rb') as f:
+            subscribers_import.run(f)
+        values['phase'] = ImportJob.COMPLETED
+    except Exception as e:
+        values['phase'] = ImportJob.FAILED
+        values['error_message'] = str(e)
+    if subscribers_import is not None:
+        values.update(
+            processed=subscribers_import.processed,
+            inserted=subscribers_import.inserted,
+            updated=subscribers_import.existing,
+            rejected=subscribers_import.rejected,
+            errors=json.dumps(subscribers_import.errors))
+    # the file contains personal data, it is not kept
+    job.file.delete(save=False)
+    ImportJob.objects.filter(pk=job.pk).update(
+        file='', finished_at=timezone.now(), **values)
+    return values.get('processed', 0)
+
+
+@app.task # noqa
+def bulk_delete_subscribers(ids):
+    """ Deletes a chunk of subscribers selected through the api """
+    deleted = delete_subscribers(ids)
+    logger.debug('deleted %d subscribers' % deleted)
+    return deleted
@@ -0,0 +1,67 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django import template
+from django.conf import settings
+
+
+class TemplateCache(object):
+    """ Process local LRU cache of compiled templates, keyed by the sha1 of
+        their source
+
+        Compiled templates are shared between renders (and threads) as the
+        django cached template loader does. The least recently used ones
+        are evicted beyond size templates.
+    """
+
+    def __init__(self, size=None):
+        self.size = size
+        self.templates = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_size(self):
+        return self.size or getattr(settings, 'NEWSLETTER_TEMPLATE_CACHE_SIZE',
+                                    64)
+
+    def get(self, source):
+        """ Returns the compiled template of source """
+        source = str(source)
+        key = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        with self.lock:
+            tpl = self.templates.get(key)
+            if tpl is not None:
+                self.templates.move_to_end(key)
+                self.hits += 1
+                return tpl
+            self.misses += 1
+        # compiled outside the lock, a concurrent miss compiles it twice
+        tpl = template.Template(source)
+        with self.lock:
+            self.templates[key] = tpl
+            while len(self.templates) > self.get_size():
+                self.templates.popitem(last=False)
+        return tpl
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'templates': len(self.templates),
+        }
+
+    def clear(self):
+        with self.lock:
+            self.templates.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+template_cache = TemplateCache()
+
+
+def compile_template(source):
+    """ Compiled template of source, from the process template cache """
+    return template_cache.get(source)
@@ -8,57 +8,22 @@ from django.contrib.sites.models import Site
 from django.core.signing import Signer
 from django.urls import reverse
 
-from ..models import Dispatch, Subscriber, SubscriberList, Tracking, FailedEmail
+from ..dashboard import admin_dashboard
 
 register = template.Library()
 
 @register.inclusion_tag('admin/dashboard.html')
 def dashboard(client):
-    THRESHOLD = 20
-
-    dispatches = Dispatch.objects.filter(
-        campaign__client=client, error=False,
-        sent__gt=THRESHOLD).order_by('-started_at')
-    bounces = FailedEmail.objects.filter(client=client)
-    subscribers_bounces = Subscriber.objects.filter(id__in=[b.subscriber.id for b in bounces])
-    last_dispatches = dispatches[:4]
-    lists = SubscriberList.objects.filter(client=client)
-    tot_subscribers = Subscriber.objects.filter(client=client).count()
-    opening_data = []
-    click_data = []
-    for d in dispatches:
-        opening_data.append({
-            'name': d.campaign.name,
-            'dt':
-            d.started_at,
-            'num':
-            Tracking.objects.filter(dispatch=d,
-                                    type=Tracking.OPEN_TYPE).count()
-        })
-        click_data.append({
-            'name': d.campaign.name,
-            'dt':
-            d.started_at,
-            'num':
-            Tracking.objects.filter(dispatch=d,
-                                    type=Tracking.CLICK_TYPE).count()
-        })
-    return {
-        'client': client,
-        'last_dispatches': last_dispatches,
-        'dispatches': dispatches,
-        'bounces': bounces,
-        'subscribers_bounces': subscribers_bounces,
-        'lists': lists,
-        'tot_subscribers': tot_subscribers,
-        'opening_data': opening_data,
-        'click_data': click_data,
-        'threshold': THRESHOLD,
-    }
+    context = admin_dashboard(client)
+    context['client'] = client
+    return context
 
 
 @register.simple_tag(takes_context=True)
 def encrypt(context, *args):
+    plan = context.get('_render_plan')
+    if plan is not None and plan.has_slots(args):
+        return plan.encrypt_slot(args)
     try:
         bs = ''.join([str(x) for x in args]).encode('utf-8')
         dig = hmac.new(
@@ -78,6 +43,10 @@ def link(context, url):
     if 'dispatch_id' not in context or 'subscriber_id' not in context:
         return url
 
+    plan = context.get('_render_plan')
+    if plan is not None:
+        return plan.link_slot(url)
+
     current_site = Site.objects.get_current()
 
     signer = Signer()
@@ -1,3 +1,672 @@
-from django.test import TestCase
+from datetime import timedelta
+from io import BytesIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from celery.exceptions import Retry
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core import mail
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from mailqueue.models import MailerMessage
+from rest_framework.exceptions import NotFound
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+
+from .bulk import add_to_lists, delete_subscribers, remove_from_lists
+from .caching import client_count
+from .delivery import DeliveryEngine, FairScheduler, QueueDrainer
+from .enqueue import MessageEnqueuer
+from .models import (Campaign, Client, Dispatch, DispatchShard,
+                     DispatchStats, FailedEmail, ImportJob, Planning,
+                     Subscriber, SubscriberList, SubscriptionForm, Topic,
+                     Tracking, Unsubscription)
+from .importing import SubscribersImport
+from .pagination import KeysetPagination
+from .rendering import CampaignRenderPlan
+from .tasks import _claim_shard, import_subscribers, send_campaign_shard
+from .tracking import store_events
+
+
+def create_dispatch(name):
+    """ A dispatch of a new client """
+    user = User.objects.create_user(name, '%s@example.com' % name, name)
+    client = Client.objects.create(user=user,
+                                   name=name,
+                                   slug=name,
+                                   domain='%s.example.com' % name)
+    topic = Topic.objects.create(client=client,
+                                 name='topic',
+                                 sending_address='news@example.com',
+                                 sending_name='news')
+    campaign = Campaign.objects.create(client=client,
+                                       name='campagna',
+                                       slug='campagna',
+                                       topic=topic,
+                                       subject='oggetto',
+                                       plain_text='',
+                                       html_text='')
+    return Dispatch.objects.create(campaign=campaign,
+                                   started_at=timezone.now())
+
+
+@override_settings(CACHES={
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+    }
+})
+class ListQueriesTestCase(TestCase):
+    """ The list endpoints run the same number of queries whatever the
+        page size, the serializers read what the viewsets query plans load
+    """
+    objects_count = 10
+
+    def setUp(self):
+        user = User.objects.create_user('client', 'client@example.com',
+                                        'client')
+        self.client_obj = Client.objects.create(user=user,
+                                                name='client',
+                                                slug='client',
+                                                domain='example.com')
+        self.api = APIClient()
+        self.api.force_authenticate(user)
+        lists = [
+            SubscriberList.objects.create(client=self.client_obj,
+                                          name='lista %d' % i)
+            for i in range(2)
+        ]
+        topic = Topic.objects.create(client=self.client_obj,
+                                     name='topic',
+                                     sending_address='news@example.com',
+                                     sending_name='news')
+        campaign = Campaign.objects.create(client=self.client_obj,
+                                           name='campagna',
+                                           slug='campagna',
+                                           topic=topic,
+                                           subject='oggetto',
+                                           plain_text='',
+                                           html_text='')
+        self.dispatch = dispatch = Dispatch.objects.create(
+            campaign=campaign, started_at=timezone.now(),
+            sent=self.objects_count)
+        Campaign.objects.bulk_create([
+            Campaign(client=self.client_obj,
+                     name='campagna %d' % i,
+                     slug='campagna-%d' % i,
+                     topic=topic,
+                     subject='oggetto',
+                     plain_text='',
+                     html_text='') for i in range(self.objects_count - 1)
+        ])
+        for i in range(self.objects_count):
+            subscriber = Subscriber.objects.create(
+                client=self.client_obj, email='iscritto%d@example.com' % i)
+            subscriber.lists.set(lists)
+            FailedEmail.objects.create(client=self.client_obj,
+                                       dispatch=dispatch,
+                                       datetime=timezone.now(),
+                                       from_email='news@example.com',
+                                       subscriber=subscriber,
+                                       email_id='bounce%d' % i)
+            planning = Planning.objects.create(campaign=campaign,
+                                               schedule=timezone.now())
+            planning.lists.set(lists)
+            form = SubscriptionForm.objects.create(client=self.client_obj,
+                                                   name='form %d' % i,
+                                                   privacy_disclaimer='privacy')
+            form.lists.set(lists)
+        SubscriberList.objects.bulk_create([
+            SubscriberList(client=self.client_obj, name='vuota %d' % i)
+            for i in range(self.objects_count - len(lists))
+        ])
+
+    def count_queries(self, url, page_size):
+        cache.clear()
+        Site.objects.clear_cache()
+        with CaptureQueriesContext(connection) as context:
+            response = self.api.get(url, {'page_size': page_size})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), page_size)
+        return len(context)
+
+    def assertConstantQueries(self, url):
+        self.assertEqual(self.count_queries(url, 2),
+                         self.count_queries(url, self.objects_count))
+
+    def test_subscribers(self):
+        self.assertConstantQueries('/api/v1/newsletter/subscriber/')
+
+    def test_subscriber_lists(self):
+        self.assertConstantQueries('/api/v1/newsletter/subscriberlist/')
+
+    def test_plannings(self):
+        self.assertConstantQueries('/api/v1/newsletter/planning/')
+
+    def test_bounces(self):
+        self.assertConstantQueries('/api/v1/newsletter/bounces/')
+
+    def test_campaigns(self):
+        self.assertConstantQueries('/api/v1/newsletter/campaign/')
+
+    def test_subscription_forms(self):
+        self.assertConstantQueries('/api/v1/newsletter/subscriptionform/')
+
+    def test_trackings_type(self):
+        url = '/api/v1/newsletter/dispatch/%d/trackings/' % self.dispatch.pk
+        self.assertEqual(self.api.get(url, {'type': 1}).status_code, 200)
+        self.assertEqual(self.api.get(url, {'type': 'open'}).status_code, 400)
+
+
+@override_settings(
+    CACHES={
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+        }
+    },
+    # no manifest, static files are not collected
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage'
+)
+class AdminDashboardTestCase(TestCase):
+    """ The admin index renders the client dashboard """
+
+    def test_admin_index(self):
+        user = User.objects.create_superuser('admin', 'admin@example.com',
+                                             'admin')
+        Client.objects.create(user=user,
+                              name='client',
+                              slug='client',
+                              domain='example.com')
+        self.client.force_login(user)
+        response = self.client.get(reverse('admin:index'))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'iscritti totali')
+
+
+class DispatchShardTestCase(TestCase):
+    """ Shards are leased to a single worker and marked done only once
+        sent
+    """
+
+    def setUp(self):
+        user = User.objects.create_user('client', 'client@example.com',
+                                        'client')
+        client = Client.objects.create(user=user,
+                                       name='client',
+                                       slug='client',
+                                       domain='example.com')
+        topic = Topic.objects.create(client=client,
+                                     name='topic',
+                                     sending_address='news@example.com',
+                                     sending_name='news')
+        campaign = Campaign.objects.create(client=client,
+                                           name='campagna',
+                                           slug='campagna',
+                                           topic=topic,
+                                           subject='oggetto',
+                                           plain_text='',
+                                           html_text='')
+        self.dispatch = Dispatch.objects.create(campaign=campaign,
+                                                started_at=timezone.now())
+        self.shard = DispatchShard.objects.create(dispatch=self.dispatch,
+                                                  first_subscriber_id=1,
+                                                  last_subscriber_id=10)
+
+    def test_lease(self):
+        self.assertIsNotNone(_claim_shard(self.shard.pk))
+        self.assertIsNone(_claim_shard(self.shard.pk))
+        self.assertFalse(DispatchShard.stale(0).exists())
+        DispatchShard.objects.filter(pk=self.shard.pk).update(
+            claimed_until=timezone.now() - timedelta(seconds=1))
+        self.assertTrue(DispatchShard.stale(15).exists())
+        self.assertIsNotNone(_claim_shard(self.shard.pk))
+
+    def test_stale_unclaimed(self):
+        self.assertFalse(DispatchShard.stale(15).exists())
+        DispatchShard.objects.filter(pk=self.shard.pk).update(
+            updated_at=timezone.now() - timedelta(minutes=16))
+        self.assertTrue(DispatchShard.stale(15).exists())
+
+    @mock.patch.object(send_campaign_shard, 'retry', side_effect=Retry)
+    def test_leased_retry(self, retry):
+        # the lease of a worker which died is still valid
+        _claim_shard(self.shard.pk)
+        with self.assertRaises(Retry):
+            send_campaign_shard(self.shard.pk)
+        self.assertGreater(retry.call_args[1]['countdown'], 290)
+        self.shard.refresh_from_db()
+        self.assertFalse(self.shard.done)
+
+    @override_settings(NEWSLETTER_SHARD_MAX_ATTEMPTS=2,
+                       NEWSLETTER_SHARD_RETRY_DELAY=60)
+    @mock.patch.object(send_campaign_shard, 'retry', side_effect=Retry)
+    @mock.patch('newsletter.tasks.CampaignRenderPlan',
+                side_effect=Exception('boom'))
+    def test_failure(self, plan, retry):
+        with self.assertRaises(Retry):
+            send_campaign_shard(self.shard.pk)
+        self.assertEqual(retry.call_args[1]['countdown'], 60)
+        self.shard.refresh_from_db()
+        self.assertFalse(self.shard.done)
+        self.assertIsNone(self.shard.claimed_until)
+        self.assertEqual(self.shard.attempts, 1)
+        send_campaign_shard(self.shard.pk)
+        self.shard.refresh_from_db()
+        self.dispatch.refresh_from_db()
+        self.assertTrue(self.shard.done)
+        self.assertTrue(self.dispatch.error)
+        self.assertFalse(self.dispatch.success)
+        self.assertIsNotNone(self.dispatch.finished_at)
+
+
+class SubscribersImportTestCase(TestCase):
+    """ Subscribers csv import jobs """
+
+    def setUp(self):
+        user = User.objects.create_user('client', 'client@example.com',
+                                        'client')
+        self.client_obj = Client.objects.create(user=user,
+                                                name='client',
+                                                slug='client',
+                                                domain='example.com')
+        self.subscriber_list = SubscriberList.objects.create(
+            client=self.client_obj, name='lista')
+
+    @mock.patch('newsletter.tasks.SubscribersImport',
+                side_effect=Exception('boom'))
+    def test_failed_setup(self, subscribers_import):
+        job = ImportJob.objects.create(client=self.client_obj)
+        job.lists.set([self.subscriber_list])
+        self.assertEqual(import_subscribers(job.pk), 0)
+        job.refresh_from_db()
+        self.assertEqual(job.phase, ImportJob.FAILED)
+        self.assertEqual(job.error_message, 'boom')
+        self.assertIsNotNone(job.finished_at)
+
+    def test_existing_mixed_case(self):
+        subscriber = Subscriber.objects.create(client=self.client_obj,
+                                               email='Mixed@Example.com')
+        subscribers_import = SubscribersImport(
+            self.client_obj, [self.subscriber_list.pk]).run(
+                BytesIO(b'Mixed@Example.com,,,0\n'
+                        b'mixed@example.com,,,0\n'
+                        b'new@example.com,,,0\n'))
+        # the repeated row counts as existing
+        self.assertEqual(subscribers_import.processed, 3)
+        self.assertEqual(subscribers_import.existing, 2)
+        self.assertEqual(subscribers_import.inserted, 1)
+        self.assertEqual(subscribers_import.rejected, 0)
+        self.assertEqual(
+            Subscriber.objects.filter(client=self.client_obj).count(), 2)
+        self.assertEqual(list(subscriber.lists.all()), [self.subscriber_list])
+
+    @skipUnless(connection.vendor == 'mysql', 'case sensitive collation')
+    def test_existing_other_case(self):
+        subscriber = Subscriber.objects.create(client=self.client_obj,
+                                               email='Mixed@Example.com')
+        subscribers_import = SubscribersImport(
+            self.client_obj, [self.subscriber_list.pk]).run(
+                BytesIO(b'mixed@example.com,,,0\n'))
+        self.assertEqual(subscribers_import.existing, 1)
+        self.assertEqual(subscribers_import.inserted, 0)
+        self.assertEqual(
+            Subscriber.objects.filter(client=self.client_obj).count(), 1)
+        self.assertEqual(list(subscriber.lists.all()), [self.subscriber_list])
+
+
+class FakeEngine(object):
+    """ Delivery engine recording the sent batches """
+    latency = 0
+    deferred_domains = set()
+
+    def __init__(self):
+        self.batches = []
+
+    def send(self, messages):
+        self.batches.append(messages)
+        MailerMessage.objects.filter(pk__in=[x.pk for x in messages]).update(
+            sent=True, last_attempt=timezone.now())
+
+
+@override_settings(MAILQUEUE_QUEUE_UP=True)
+class QueueDrainerTestCase(TestCase):
+    """ The drainer claims the messages of every client round robin """
+
+    def enqueue(self, dispatch, count, domain='example.com'):
+        MailerMessage.objects.bulk_create([
+            MailerMessage(app=str(dispatch.pk),
+                          subject='oggetto',
+                          to_address='iscritto%d@%s' % (i, domain),
+                          from_address='news@example.com',
+                          content='') for i in range(count)
+        ])
+
+    def test_clients_interleave(self):
+        # the first client has the older backlog
+        first, second = create_dispatch('first'), create_dispatch('second')
+        self.enqueue(first, 60)
+        self.enqueue(second, 5)
+        engine = FakeEngine()
+        QueueDrainer(engine, batch_size=10, rate=100000).drain()
+        self.assertEqual(len(engine.batches[0]), 10)
+        self.assertEqual(
+            sorted([x.app for x in engine.batches[0]]),
+            [str(first.pk)] * 5 + [str(second.pk)] * 5)
+
+    def test_throttled_domain(self):
+        dispatch = create_dispatch('client')
+        self.enqueue(dispatch, 10, 'slow.com')
+        self.enqueue(dispatch, 10, 'fast.com')
+        engine = FakeEngine()
+        scheduler = FairScheduler(domain_rates={'slow.com': (0.001, 1)})
+        drainer = QueueDrainer(engine,
+                               batch_size=10,
+                               rate=100000,
+                               scheduler=scheduler)
+        self.assertEqual(drainer.drain(), 1)
+        # the throttled domain messages no longer fill the claims
+        self.assertEqual(drainer.drain(), 10)
+        self.assertTrue(
+            all([x.to_address.endswith('@fast.com')
+                 for x in engine.batches[1]]))
+
+    def test_send_queued(self):
+        self.enqueue(create_dispatch('client'), 15)
+        engine = DeliveryEngine(connections=2, batch_size=10)
+        try:
+            engine.send_queued(limit=100)
+        finally:
+            engine.close()
+        self.assertEqual(len(mail.outbox), 15)
+        self.assertFalse(MailerMessage.objects.filter(sent=False).exists())
+
+
+@override_settings(CACHES={
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+    }
+})
+class CampaignRenderPlanTestCase(TestCase):
+    """ Compiled plans render every message as the full render does """
+
+    def setUp(self):
+        self.dispatch = create_dispatch('client')
+        # the first recipient email is already upper case
+        self.subscribers = [
+            Subscriber.objects.create(client=self.dispatch.campaign.client,
+                                      email=email)
+            for email in ('ABC@EXAMPLE.COM', 'abcdefghijklmn@example.com',
+                          'a@example.com')
+        ]
+
+    def assertRendersFull(self, source, compiled):
+        campaign = self.dispatch.campaign
+        campaign.plain_text = source
+        campaign.html_text = '<html><body>%s</body></html>' % source
+        plan = CampaignRenderPlan(campaign, self.dispatch)
+        self.assertEqual(plan.compiled, compiled)
+        for subscriber in self.subscribers:
+            self.assertEqual(plan.render(subscriber),
+                             plan._render_full(subscriber))
+
+    def test_plain_variables(self):
+        self.assertRendersFull(
+            '{{ email }} {{ subscriber_id }} {{ email|safe }} '
+            '{% encrypt subscriber_id email %} '
+            '<a href="{% link "http://www.example.com" %}">link</a>', True)
+
+    def test_filters(self):
+        self.assertRendersFull('{{ email|upper }}', False)
+        self.assertRendersFull('{{ email|truncatechars:10 }}', False)
+        self.assertRendersFull('{{ email|slice:":3" }}', False)
+        self.assertRendersFull('{% encrypt email|lower %}', False)
+
+    def test_lookups_and_conditions(self):
+        self.assertRendersFull('{{ email.upper }}', False)
+        self.assertRendersFull(
+            '{% if email == "a@example.com" %}si{% else %}no{% endif %}',
+            False)
+        self.assertRendersFull(
+            '{% with address=email %}{{ address }}{% endwith %}', False)
+
+
+class BulkSubscribersTestCase(TestCase):
+    """ Set based subscribers operations """
+
+    def setUp(self):
+        self.dispatch = create_dispatch('client')
+        self.client_obj = self.dispatch.campaign.client
+        self.lists = [
+            SubscriberList.objects.create(client=self.client_obj,
+                                          name='lista %d' % i)
+            for i in range(2)
+        ]
+        self.subscribers = []
+        for i in range(3):
+            subscriber = Subscriber.objects.create(
+                client=self.client_obj, email='iscritto%d@example.com' % i)
+            subscriber.lists.set(self.lists[:1])
+            self.subscribers.append(subscriber)
+
+    def test_delete_subscribers(self):
+        deleted = self.subscribers[:2]
+        for subscriber in self.subscribers:
+            Tracking.objects.create(type=Tracking.OPEN_TYPE,
+                                    dispatch=self.dispatch,
+                                    subscriber=subscriber)
+            FailedEmail.objects.create(client=self.client_obj,
+                                       dispatch=self.dispatch,
+                                       datetime=timezone.now(),
+                                       from_email='news@example.com',
+                                       subscriber=subscriber,
+                                       email_id='bounce%d' % subscriber.pk)
+        self.assertEqual(
+            delete_subscribers([x.pk for x in deleted], chunk_size=1), 2)
+        self.assertEqual(list(Subscriber.objects.all()),
+                         self.subscribers[2:])
+        self.assertEqual(Tracking.objects.count(), 1)
+        self.assertEqual(FailedEmail.objects.count(), 1)
+        self.assertEqual(
+            Subscriber.lists.through.objects.filter(
+                subscriber_id__in=[x.pk for x in deleted]).count(), 0)
+        self.assertEqual(
+            Unsubscription.objects.filter(client=self.client_obj).count(), 2)
+
+    def test_add_to_lists(self):
+        add_to_lists(
+            Subscriber.objects.filter(
+                pk__in=[x.pk for x in self.subscribers[1:]]),
+            [x.pk for x in self.lists])
+        self.assertEqual(list(self.subscribers[0].lists.all()),
+                         self.lists[:1])
+        for subscriber in self.subscribers[1:]:
+            self.assertEqual(
+                list(subscriber.lists.order_by('id')), self.lists)
+
+    def test_remove_from_lists(self):
+        remove_from_lists(
+            Subscriber.objects.filter(
+                pk__in=[x.pk for x in self.subscribers[1:]]),
+            [x.pk for x in self.lists])
+        self.assertEqual(list(self.subscribers[0].lists.all()),
+                         self.lists[:1])
+        for subscriber in self.subscribers[1:]:
+            self.assertFalse(subscriber.lists.exists())
+        # the subscribers are kept
+        self.assertEqual(Subscriber.objects.count(), 3)
+
+
+class KeysetPaginationTestCase(TestCase):
+    """ Cursor pages on (sort key, id) """
+
+    def setUp(self):
+        # the same emails for two clients, the sort key is not unique
+        for name in ('first', 'second'):
+            client = create_dispatch(name).campaign.client
+            for i in range(5):
+                Subscriber.objects.create(
+                    client=client,
+                    email='iscritto%d@example.com' % i,
+                    opt_in_datetime=timezone.now() if i % 2 else None)
+
+    def request(self, **params):
+        return Request(APIRequestFactory().get('/', params))
+
+    def walk(self, queryset, page_size):
+        """ Ids of all the pages, following the next links """
+        ids = []
+        params = {'page_size': page_size}
+        while True:
+            paginator = KeysetPagination()
+            ids += [
+                x.pk
+                for x in paginator.paginate_queryset(queryset,
+                                                     self.request(**params))
+            ]
+            if not paginator.has_next:
+                return ids
+            params['cursor'] = paginator.encode_cursor(paginator.page[-1])
+
+    def test_ties_on_id(self):
+        queryset = Subscriber.objects.order_by('email')
+        self.assertEqual(
+            self.walk(queryset, 3),
+            list(queryset.order_by('email', 'id').values_list('id',
+                                                              flat=True)))
+
+    def test_descending(self):
+        queryset = Subscriber.objects.order_by('-email')
+        self.assertEqual(
+            self.walk(queryset, 4),
+            list(queryset.order_by('-email', '-id').values_list('id',
+                                                                flat=True)))
+
+    def test_nullable_key(self):
+        queryset = Subscriber.objects.order_by('-opt_in_datetime')
+        self.assertEqual(KeysetPagination().get_sort_key(queryset),
+                         ('id', True))
+        self.assertEqual(
+            self.walk(queryset, 3),
+            list(queryset.order_by('-id').values_list('id', flat=True)))
+
+    def test_cursor(self):
+        paginator = KeysetPagination()
+        paginator.key = 'email'
+        subscriber = Subscriber.objects.first()
+        cursor = paginator.encode_cursor(subscriber)
+        self.assertEqual(
+            paginator.decode_cursor(self.request(cursor=cursor)),
+            (subscriber.email, subscriber.pk))
+        with self.assertRaises(NotFound):
+            paginator.decode_cursor(self.request(cursor='not-a-cursor'))
+
+
+class StoreEventsTestCase(TestCase):
+    """ Buffered tracking events are deduplicated and counted """
+
+    def setUp(self):
+        self.dispatch = create_dispatch('client')
+        self.subscriber = Subscriber.objects.create(
+            client=self.dispatch.campaign.client, email='a@example.com')
+
+    def stats(self):
+        stats = DispatchStats.objects.get(dispatch=self.dispatch)
+        return (stats.unique_opens, stats.total_opens, stats.unique_clickers,
+                stats.total_clicks)
+
+    def test_dedupe_and_counters(self):
+        now = timezone.now().timestamp()
+        dispatch_id, subscriber_id = self.dispatch.pk, self.subscriber.pk
+        events = [
+            [Tracking.OPEN_TYPE, dispatch_id, subscriber_id, None, now + 1],
+            [Tracking.OPEN_TYPE, dispatch_id, subscriber_id, None, now],
+            [Tracking.CLICK_TYPE, dispatch_id, subscriber_id, 'http://a', now],
+            [Tracking.CLICK_TYPE, dispatch_id, subscriber_id, 'http://a', now],
+            [Tracking.CLICK_TYPE, dispatch_id, subscriber_id, 'http://b', now],
+            # deleted subscriber
+            [Tracking.OPEN_TYPE, dispatch_id, subscriber_id + 1, None, now],
+        ]
+        self.assertEqual(len(store_events(events)), 3)
+        open_tracking = Tracking.objects.get(type=Tracking.OPEN_TYPE)
+        # the first open is kept
+        self.assertAlmostEqual(open_tracking.datetime.timestamp(), now,
+                               places=3)
+        self.assertEqual(self.stats(), (1, 2, 1, 3))
+        # stored events are not written again, totals keep counting
+        self.assertEqual(store_events(events), [])
+        self.assertEqual(Tracking.objects.count(), 3)
+        self.assertEqual(self.stats(), (1, 4, 1, 6))
+
+
+@override_settings(CACHES={
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+    }
+})
+class ClientCountTestCase(TestCase):
+    """ Cached client counts are dropped when the client rows change """
+
+    def setUp(self):
+        cache.clear()
+        self.dispatch = create_dispatch('client')
+        self.client_obj = self.dispatch.campaign.client
+        self.subscriber_list = SubscriberList.objects.create(
+            client=self.client_obj, name='lista')
+
+    def count(self):
+        return client_count(
+            Subscriber.objects.filter(client=self.client_obj),
+            self.client_obj.user_id)
+
+    def test_save_and_delete(self):
+        self.assertEqual(self.count(), 0)
+        subscriber = Subscriber.objects.create(client=self.client_obj,
+                                               email='a@example.com')
+        self.assertEqual(self.count(), 1)
+        subscriber.delete()
+        self.assertEqual(self.count(), 0)
+
+    def test_set_based_writes(self):
+        self.assertEqual(self.count(), 0)
+        SubscribersImport(self.client_obj, [self.subscriber_list.pk]).run(
+            BytesIO(b'a@example.com,,,0\nb@example.com,,,0\n'))
+        self.assertEqual(self.count(), 2)
+        delete_subscribers(
+            Subscriber.objects.filter(email='a@example.com').values_list(
+                'id', flat=True))
+        self.assertEqual(self.count(), 1)
+
+    def test_other_client(self):
+        self.assertEqual(self.count(), 0)
+        Subscriber.objects.create(
+            client=create_dispatch('other').campaign.client,
+            email='a@example.com')
+        self.assertEqual(self.count(), 0)
+
+
+@override_settings(MAILQUEUE_QUEUE_UP=True)
+class MessageEnqueuerTestCase(TestCase):
+    """ Messages are written with bulk inserts """
+
+    def test_bulk_failure(self):
+        dispatch = create_dispatch('client')
+        enqueuer = MessageEnqueuer(dispatch)
+        for i in range(3):
+            enqueuer.add(
+                MailerMessage(app=str(dispatch.pk),
+                              subject='oggetto',
+                              to_address='iscritto%d@example.com' % i,
+                              from_address='news@example.com',
+                              content=''), i)
+        with mock.patch.object(MailerMessage.objects, 'bulk_create',
+                               side_effect=Exception('boom')), \
+                self.assertLogs('newsletter.enqueue', 'ERROR') as logs:
+            enqueuer.flush()
+        self.assertIn('boom', logs.output[0])
+        # saved one by one
+        self.assertEqual(enqueuer.sent, 3)
+        self.assertEqual(
+            MailerMessage.objects.filter(app=str(dispatch.pk)).count(), 3)
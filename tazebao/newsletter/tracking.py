@@ -0,0 +1,177 @@
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Dispatch, DispatchStats, Subscriber, Tracking
+
+logger = logging.getLogger(__name__)
+
+EVENTS_KEY = 'newsletter:tracking-events'
+
+
+class RedisEventBuffer(object):
+    """ Append only buffer of tracking events kept in a redis list, through
+        the django_redis cache connection
+    """
+
+    def __init__(self, key=EVENTS_KEY):
+        self.key = key
+
+    @property
+    def connection(self):
+        from django_redis import get_redis_connection
+        return get_redis_connection('default')
+
+    def push(self, event):
+        self.connection.rpush(self.key, json.dumps(event))
+
+    def pop(self, size):
+        """ Removes and returns up to size events """
+        pipe = self.connection.pipeline()
+        pipe.lrange(self.key, 0, size - 1)
+        pipe.ltrim(self.key, size, -1)
+        events, trimmed = pipe.execute()
+        return [json.loads(x) for x in events]
+
+
+class LocalEventBuffer(object):
+    """ In memory stand-in of the redis buffer, for tests and development """
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def push(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def pop(self, size):
+        with self.lock:
+            events, self.events = self.events[:size], self.events[size:]
+        return events
+
+
+_local_buffer = LocalEventBuffer()
+
+
+def get_buffer():
+    if getattr(settings, 'NEWSLETTER_TRACKING_BUFFER', 'redis') == 'local':
+        return _local_buffer
+    return RedisEventBuffer()
+
+
+def _push(event):
+    try:
+        get_buffer().push(event)
+    except Exception as e:
+        # never lose an event, store it right away
+        logger.error('tracking buffer error: %s' % e)
+        store_events([event])
+
+
+def track_open(dispatch_id, subscriber_id):
+    _push([Tracking.OPEN_TYPE, dispatch_id, subscriber_id, None, time.time()])
+
+
+def track_click(dispatch_id, subscriber_id, url):
+    _push([Tracking.CLICK_TYPE, dispatch_id, subscriber_id, url, time.time()])
+
+
+def store_events(events):
+    """ Writes the tracking rows of the given events, returns them
+
+        Opens are unique per dispatch and subscriber, clicks per dispatch,
+        subscriber and url: duplicated events and the ones already stored
+        are discarded, as are the ones of deleted dispatches or subscribers.
+        The dispatches stats counters are incremented accordingly.
+    """
+    unique = {}
+    # (type, dispatch id, subscriber id): events count
+    totals = {}
+    for type, dispatch_id, subscriber_id, url, timestamp in events:
+        notes = (url or '')[:255] if type == Tracking.CLICK_TYPE else None
+        key = (type, int(dispatch_id), int(subscriber_id), notes)
+        if key not in unique or unique[key] > timestamp:
+            unique[key] = timestamp
+        totals[key[:3]] = totals.get(key[:3], 0) + 1
+    if not unique:
+        return []
+    dispatch_ids = set([x[1] for x in unique.keys()])
+    subscriber_ids = set([x[2] for x in unique.keys()])
+    dispatch_ids = set(
+        Dispatch.objects.filter(id__in=dispatch_ids).values_list('id',
+                                                                 flat=True))
+    subscriber_ids = set(
+        Subscriber.objects.filter(id__in=subscriber_ids).values_list(
+            'id', flat=True))
+    existing = set(
+        Tracking.objects.filter(
+            dispatch_id__in=dispatch_ids,
+            subscriber_id__in=subscriber_ids).values_list(
+                'type', 'dispatch_id', 'subscriber_id', 'notes'))
+    opened = set([x[1:3] for x in existing if x[0] == Tracking.OPEN_TYPE])
+    clicked = set([x[1:3] for x in existing if x[0] == Tracking.CLICK_TYPE])
+    trackings = []
+    for key, timestamp in sorted(unique.items(), key=lambda x: x[1]):
+        type, dispatch_id, subscriber_id, notes = key
+        if dispatch_id not in dispatch_ids or subscriber_id not in subscriber_ids: # noqa
+            continue
+        if type == Tracking.OPEN_TYPE and (dispatch_id,
+                                           subscriber_id) in opened:
+            continue
+        if key in existing:
+            continue
+        trackings.append(
+            Tracking(type=type,
+                     dispatch_id=dispatch_id,
+                     subscriber_id=subscriber_id,
+                     notes=notes,
+                     datetime=datetime.fromtimestamp(timestamp, timezone.utc)))
+    # dispatch id: counters
+    counters = {}
+    for (type, dispatch_id, subscriber_id), count in totals.items():
+        if dispatch_id not in dispatch_ids or subscriber_id not in subscriber_ids: # noqa
+            continue
+        dispatch_counters = counters.setdefault(dispatch_id, {
+            'unique_opens': 0,
+            'total_opens': 0,
+            'unique_clickers': 0,
+            'total_clicks': 0,
+        })
+        if type == Tracking.OPEN_TYPE:
+            dispatch_counters['total_opens'] += count
+        else:
+            dispatch_counters['total_clicks'] += count
+    for tracking in trackings:
+        pair = (tracking.dispatch_id, tracking.subscriber_id)
+        if tracking.type == Tracking.OPEN_TYPE:
+            counters[tracking.dispatch_id]['unique_opens'] += 1
+        elif pair not in clicked:
+            clicked.add(pair)
+            counters[tracking.dispatch_id]['unique_clickers'] += 1
+    # missing stats are computed before the new rows are written
+    DispatchStats.ensure(counters.keys())
+    with transaction.atomic():
+        Tracking.objects.bulk_create(trackings)
+        for dispatch_id, dispatch_counters in counters.items():
+            DispatchStats.increment(dispatch_id, **dispatch_counters)
+    return trackings
+
+
+def ingest_events(batch_size=None):
+    """ Stores the buffered events, returns the number of new rows """
+    batch_size = batch_size or getattr(settings,
+                                       'NEWSLETTER_TRACKING_BATCH_SIZE', 1000)
+    buffer = get_buffer()
+    created = 0
+    while True:
+        events = buffer.pop(batch_size)
+        if not events:
+            return created
+        created += len(store_events(events))
@@ -1,23 +1,20 @@
 import base64
-import csv
 import json
 import random
 import string
 import time
 import logging
-from datetime import date, datetime, timedelta
+from datetime import datetime, timedelta
 from urllib.parse import unquote, unquote_plus
 from rest_framework.compat import requests
 from openai import OpenAI
 from getenv import env
 
-from dateutil.relativedelta import relativedelta
 from django import http, template
 from django.conf import settings
 from django.core.signing import Signer
-from django.core.validators import validate_email
 from django.db import IntegrityError, transaction
-from django.db.models import Q, Count
+from django.db.models import Q, Count, OuterRef, Prefetch, Subquery
 from django.http import (
     Http404,
     HttpResponse,
@@ -33,7 +30,7 @@ from django.contrib import messages
 from rest_framework import mixins, viewsets
 from rest_framework.decorators import action
 from rest_framework.exceptions import ValidationError
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import CursorPagination, PageNumberPagination
 from rest_framework.parsers import FormParser, MultiPartParser
 from rest_framework.response import Response
 from rest_framework.views import APIView
@@ -43,12 +40,17 @@ from mosaico.serializers import TemplateSerializer
 from newsletter.forms import SubscriptionPageForm
 
 from .auth import PostfixNewsletterAPISignatureAuthentication
+from .bulk import add_to_lists, delete_chunks, delete_subscribers, remove_from_lists
+from .caching import client_count, client_stats, invalidate_client_counts
 from .context import get_campaign_context
 from .models import (
     Campaign,
     Client,
+    DailyStats,
     Dispatch,
+    DispatchStats,
     FailedEmail,
+    ImportJob,
     MailerMessage,
     Planning,
     Subscriber,
@@ -59,13 +61,17 @@ from .models import (
     SystemMessageRead,
     Topic,
     Tracking,
-    Unsubscription,
 )
+from .pagination import KeysetPagination
 from .permissions import IsClient, IsMailerMessageClient
 from .serializers import (
     CampaignSerializer,
+    CampaignSummarySerializer,
+    DailyStatsSerializer,
     DispatchSerializer,
+    DispatchSummarySerializer,
     FailedEmailSerializer,
+    ImportJobSerializer,
     MailerMessageSerializer,
     PlanningSerializer,
     SubscriberListSerializer,
@@ -75,9 +81,18 @@ from .serializers import (
     TopicSerializer,
     UnsubscriptionStatsSerializer,
     SystemMessageSerializer,
+    TrackingSerializer,
 )
-from .tasks import send_campaign, test_campaign
+from .stats import dashboard_stats
+from .tasks import (
+    bulk_delete_subscribers,
+    import_subscribers,
+    send_campaign,
+    test_campaign,
+)
+from .templatecache import compile_template
 from .templatetags.newsletter_tags import encrypt
+from .tracking import track_click, track_open
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -199,7 +214,7 @@ def campaign_detail_view(request, client_slug, year, month, day, campaign_slug):
                 )
                 dispatch = get_object_or_404(Dispatch, id=int(request.GET["dispatch"]))
 
-                unsubscribe_url_template = template.Template(
+                unsubscribe_url_template = compile_template(
                     "{% load newsletter_tags %}"
                     + (
                         ""
@@ -222,10 +237,10 @@ def campaign_detail_view(request, client_slug, year, month, day, campaign_slug):
             and campaign.html_text != ""
             and not request.GET.get("txt", False)
         ):
-            tpl = template.Template("{% load newsletter_tags %}" + campaign.html_text)  # noqa
+            tpl = compile_template("{% load newsletter_tags %}" + campaign.html_text)
             content_type = "text/html; charset=utf-8"
         else:
-            tpl = template.Template(campaign.plain_text)
+            tpl = compile_template(campaign.plain_text)
             content_type = "text/plain; charset=utf-8"
         context = template.Context({})
         context.update(get_campaign_context(campaign, subscriber))
@@ -249,16 +264,8 @@ def email_tracking(request, dispatch_id, subscriber_id):
     if s != request.GET.get("s", ""):
         raise http.Http404()
 
-    dispatch = get_object_or_404(Dispatch, id=dispatch_id)
-    subscriber = get_object_or_404(Subscriber, id=subscriber_id)
-    tracking = Tracking.objects.filter(
-        dispatch=dispatch, subscriber=subscriber, type=Tracking.OPEN_TYPE
-    )
-    if not tracking.count():
-        new_tracking = Tracking(
-            dispatch=dispatch, subscriber=subscriber, type=Tracking.OPEN_TYPE
-        )
-        new_tracking.save()
+    # stored asynchronously by the ingest_tracking_events consumer
+    track_open(dispatch_id, subscriber_id)
 
     PIXEL_GIF_DATA = base64.b64decode(
         """
@@ -277,14 +284,8 @@ def link_tracking(request, dispatch_id, subscriber_id):
     if s != request.GET.get("s", ""):
         raise http.Http404()
 
-    dispatch = get_object_or_404(Dispatch, id=dispatch_id)
-    subscriber = get_object_or_404(Subscriber, id=subscriber_id)
-    tracking, created = Tracking.objects.get_or_create(
-        dispatch=dispatch,
-        subscriber=subscriber,
-        type=Tracking.CLICK_TYPE,
-        notes=request.GET.get("url", ""),
-    )
+    # stored asynchronously by the ingest_tracking_events consumer
+    track_click(dispatch_id, subscriber_id, request.GET.get("url", ""))
 
     return HttpResponseRedirect(request.GET.get("url"))
 
@@ -305,16 +306,32 @@ class AllResultsSetPagination(PageNumberPagination):
     page_size_query_param = "page_size"
 
 
+class EventsCursorPagination(CursorPagination):
+    page_size = 100
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+    ordering = "-id"
+
+
 class DynamicPagination(object):
     @property
     def paginator(self):
         """
         The paginator instance associated with the view, or `None`.
         """
+        # keyset pagination, requested with the cursor param
+        if (
+            getattr(self, "keyset_pagination_class", None) is not None
+            and "cursor" in self.request.query_params
+        ):
+            if not isinstance(getattr(self, "_paginator", None), KeysetPagination):
+                self._paginator = self.keyset_pagination_class()
+            return self._paginator
         # do not paginate under 5000
         if (
             self.request.query_params.get("page_size", None) is None
-            and self.get_for_client().count() < self.pagination_threshold
+            and client_count(self.get_for_client(), self.request.user.id)
+            < self.pagination_threshold
         ):
             self._paginator = None
         else:
@@ -326,6 +343,33 @@ class DynamicPagination(object):
         return self._paginator
 
 
+class QueryPlanMixin(object):
+    """Applies to the listed and retrieved objects the query plan their
+    serializer needs: related objects to join or prefetch and the annotations
+    which replace per object lookups.
+    """
+
+    plan_select_related = ()
+    plan_prefetch_related = ()
+
+    def get_plan_annotations(self):
+        return {}
+
+    def filter_queryset(self, queryset):
+        queryset = super(QueryPlanMixin, self).filter_queryset(queryset)
+        return self.apply_query_plan(queryset)
+
+    def apply_query_plan(self, queryset):
+        if self.plan_select_related:
+            queryset = queryset.select_related(*self.plan_select_related)
+        if self.plan_prefetch_related:
+            queryset = queryset.prefetch_related(*self.plan_prefetch_related)
+        annotations = self.get_plan_annotations()
+        if annotations:
+            queryset = queryset.annotate(**annotations)
+        return queryset
+
+
 class SubscriberListViewSet(DynamicPagination, viewsets.ModelViewSet):
     """SubscriberList CRUD"""
 
@@ -354,7 +398,7 @@ class SubscriberListViewSet(DynamicPagination, viewsets.ModelViewSet):
             order = "%s%s" % ("-" if sort_direction == "desc" else "", sort)
         else:  # default ordering
             order = "-id"
-        qs = qs.order_by(order)
+        qs = qs.annotate(tot_subscribers=Count("subscriber")).order_by(order)
         return qs
 
     def get_for_client(self):
@@ -389,83 +433,42 @@ class ImportSubscribersFromCsv(APIView):
                 SubscriberList.objects.get(client=request.user.client, id=list_id)
             except:
                 return Response({"detail": "Invalid list"}, status=400)
-        decoded_file = file.read().decode("utf-8").splitlines()
-        reader = csv.reader(decoded_file)
-        rows = list(reader)
-        if len(rows) > 1000:
-            return Response(
-                {
-                    "detail": "Limite massimo raggiunto: non puoi importare più di 1000 contatti alla volta"
-                },
-                status=400,
-            )
-        try:
-            with transaction.atomic():
-                for row in rows:
-                    if len(row) != 5 and len(row) != 4:
-                        raise Exception("Il file importato non è del formato corretto")
-                    email = row[0]
-                    subscription_datetime = row[1].strip()
-                    info = row[2]
-                    opt_in = int(row[3])
-                    if opt_in and len(row) == 5:
-                        opt_in_datetime = row[4].strip()
-                        if not opt_in_datetime:
-                            raise Exception(
-                                "%s: in caso di opt in ad 1 deve essere specificata la data"
-                                % email
-                            )
-                    elif opt_in and len(row) == 4:
-                        raise Exception(
-                            "$s: in caso di opt in ad 1 deve essere specificata la data"
-                            % email
-                        )
-                    else:
-                        opt_in_datetime = None
-
-                    try:
-                        validate_email(email)
-                    except Exception:
-                        raise Exception("%s non è un indirizzo e-mail valido" % email)
-
-                    if not subscription_datetime:
-                        subscription_datetime = datetime.now()
-                    if info:
-                        try:
-                            json.loads(info)
-                        except ValueError:
-                            raise Exception(
-                                "La colonna informazioni deve contenere un JSON valido"
-                            )
-
-                    (
-                        subscriber,
-                        created,
-                    ) = Subscriber.objects.get_or_create(
-                        client=request.user.client,
-                        email=email,
-                        defaults={
-                            "subscription_datetime": subscription_datetime,
-                            "opt_in": opt_in,
-                            "info": info,
-                            "opt_in_datetime": opt_in_datetime,
-                        },
-                    )
-                    # trying to add a list already present causes an Exception and problems
-                    # inside the atomic block
-                    for list_id in lists:
-                        if created or int(list_id) not in [
-                            id for id in subscriber.lists.all()
-                        ]:
-                            subscriber.lists.add(int(list_id))
-        except Exception as e:
-            return Response({"detail": str(e)}, status=400)
-
-        response = {"description": "Importazione avvenuta con successo"}
+        # the file is stored on disk and imported by a celery task,
+        # the job progress is exposed by ImportJobViewSet
+        job = ImportJob(client=request.user.client)
+        job.file.save(file.name, file, save=False)
+        job.save()
+        job.lists.set(lists)
+        import_subscribers.delay(job.pk)
+
+        response = {
+            "description": "Importazione avviata",
+            "job": ImportJobSerializer(job).data,
+        }
         return Response(response)
 
 
-class PlanningViewSet(DynamicPagination, viewsets.ModelViewSet):
+class ImportJobViewSet(viewsets.ReadOnlyModelViewSet):
+    """Subscribers import jobs progress"""
+
+    lookup_field = "pk"
+    queryset = ImportJob.objects.all()
+    serializer_class = ImportJobSerializer
+    pagination_class = ResultsSetPagination
+
+    def get_permissions(self):
+        """Only client users can perform object actions"""
+        return [
+            IsClient(),
+        ]
+
+    def get_queryset(self):
+        return ImportJob.objects.filter(
+            client__user__id=self.request.user.id
+        ).order_by("-id")
+
+
+class PlanningViewSet(QueryPlanMixin, DynamicPagination, viewsets.ModelViewSet):
     """SubscriberList CRUD"""
 
     lookup_field = "pk"
@@ -473,6 +476,8 @@ class PlanningViewSet(DynamicPagination, viewsets.ModelViewSet):
     serializer_class = PlanningSerializer
     pagination_class = ResultsSetPagination
     pagination_threshold = 10000
+    plan_select_related = ("campaign",)
+    plan_prefetch_related = ("lists",)
 
     def get_permissions(self):
         """Only client users can perform object actions"""
@@ -502,14 +507,16 @@ class PlanningViewSet(DynamicPagination, viewsets.ModelViewSet):
         return Planning.objects.filter(campaign__client__user__id=self.request.user.id)
 
 
-class FailedEmailViewSet(DynamicPagination, viewsets.ModelViewSet):
+class FailedEmailViewSet(QueryPlanMixin, DynamicPagination, viewsets.ModelViewSet):
     """FailedEmail CRUD"""
 
     lookup_field = "pk"
     queryset = FailedEmail.objects.all()
     serializer_class = FailedEmailSerializer
     pagination_class = ResultsSetPagination
+    keyset_pagination_class = KeysetPagination
     pagination_threshold = 1000
+    plan_select_related = ("subscriber", "dispatch__campaign")
 
     def get_permissions(self):
         """Only client users can perform object actions"""
@@ -544,14 +551,16 @@ class FailedEmailViewSet(DynamicPagination, viewsets.ModelViewSet):
         return FailedEmail.objects.filter(client__user__id=self.request.user.id)
 
 
-class SubscriberViewSet(DynamicPagination, viewsets.ModelViewSet):
+class SubscriberViewSet(QueryPlanMixin, DynamicPagination, viewsets.ModelViewSet):
     """Subscriber CRUD"""
 
     lookup_field = "pk"
     queryset = Subscriber.objects.all()
     serializer_class = SubscriberSerializer
     pagination_class = ResultsSetPagination
+    keyset_pagination_class = KeysetPagination
     pagination_threshold = 8000
+    plan_prefetch_related = ("lists",)
 
     def get_permissions(self):
         """Only client users can perform object actions"""
@@ -561,14 +570,26 @@ class SubscriberViewSet(DynamicPagination, viewsets.ModelViewSet):
 
     def get_queryset(self):
         """Retrieves only clients subscribers"""
-        qs = self.get_for_client()
+        qs = self.filter_subscribers(self.get_for_client(), self.request.query_params)
 
-        q = self.request.query_params.get("q", None)
-        lists = self.request.query_params.get("lists", None)
-        email = self.request.query_params.get("email", None)
-        info = self.request.query_params.get("info", None)
         sort = self.request.query_params.get("sort", None)
         sort_direction = self.request.query_params.get("sort_direction", None)
+        if sort is not None:
+            order = "%s%s" % ("-" if sort_direction == "desc" else "", sort)
+        else:  # default ordering
+            order = "-id"
+        qs = qs.order_by(order)
+        return qs
+
+    def get_for_client(self):
+        return Subscriber.objects.filter(client__user__id=self.request.user.id)
+
+    def filter_subscribers(self, qs, params):
+        """Applies the q, email, info and lists filters"""
+        q = params.get("q", None)
+        lists = params.get("lists", None)
+        email = params.get("email", None)
+        info = params.get("info", None)
         if email is not None:
             qs = qs.filter(email__icontains=email)
         if info is not None:
@@ -577,15 +598,31 @@ class SubscriberViewSet(DynamicPagination, viewsets.ModelViewSet):
             qs = qs.filter(lists__id__in=[int(lists)])
         if q is not None:
             qs = qs.filter(Q(email__icontains=q) | Q(info__icontains=q))
-        if sort is not None:
-            order = "%s%s" % ("-" if sort_direction == "desc" else "", sort)
-        else:  # default ordering
-            order = "-id"
-        qs = qs.order_by(order)
         return qs
 
-    def get_for_client(self):
-        return Subscriber.objects.filter(client__user__id=self.request.user.id)
+    def get_selection(self, request):
+        """Subscribers and lists of a bulk list operation
+
+        Subscribers are given either as a list of ids (subscribers) or as
+        the filters of the subscribers list (filters), lists as a list of
+        ids of client's lists.
+        """
+        try:
+            lists_ids = set([int(x) for x in request.data.get("lists")])
+            filters = request.data.get("filters", None)
+            if filters is not None:
+                qs = self.filter_subscribers(self.get_for_client(), filters)
+            else:
+                qs = self.get_for_client().filter(
+                    id__in=[int(x) for x in request.data.get("subscribers")]
+                )
+        except (TypeError, ValueError, AttributeError):
+            raise ValidationError(detail={"detail": "unexisting subscriber or list"})
+        if not lists_ids or SubscriberList.objects.filter(
+            id__in=lists_ids, client=request.user.client
+        ).count() != len(lists_ids):
+            raise ValidationError(detail={"detail": "unexisting subscriber or list"})
+        return qs, lists_ids
 
     def perform_create(self, serializer):
         """Automatically set the client field"""
@@ -600,43 +637,42 @@ class SubscriberViewSet(DynamicPagination, viewsets.ModelViewSet):
 
     @action(detail=False, methods=["post"])
     def add_list(self, request):
-        subscribers = request.data.get("subscribers")
-        for subscriber_id in subscribers:
-            try:
-                subscriber = Subscriber.objects.get(
-                    id=int(subscriber_id), client=request.user.client
-                )
-                subscriber.lists.add(*request.data.get("lists"))
-            except IntegrityError:
-                pass
-            except Exception as e:
-                print(e)
-                return HttpResponseBadRequest("unexisting subscriber or list")
+        qs, lists_ids = self.get_selection(request)
+        with transaction.atomic():
+            add_to_lists(qs, lists_ids)
         return Response({})
 
-    @transaction.atomic
     @action(detail=False, methods=["post"])
     def remove_list(self, request):
-        subscribers = request.data.get("subscribers")
-        for subscriber_id in subscribers:
-            try:
-                subscriber = Subscriber.objects.get(
-                    id=int(subscriber_id), client=request.user.client
-                )
-                subscriber.lists.remove(*request.data.get("lists"))
-            except Exception as e:
-                print(e)
-                return HttpResponseBadRequest("unexisting subscriber or list")
+        qs, lists_ids = self.get_selection(request)
+        with transaction.atomic():
+            remove_from_lists(qs, lists_ids)
         return Response({})
 
+    def delete_subscribers(self, qs):
+        """Deletes the selected subscribers
+
+        Large selections are deleted in background, chunk by chunk.
+        """
+        ids = sorted(set(qs.values_list("id", flat=True)))
+        if len(ids) > getattr(settings, "NEWSLETTER_DELETE_SYNC_LIMIT", 1000):
+            for chunk in delete_chunks(ids):
+                bulk_delete_subscribers.delay(chunk)
+            return Response(
+                {"detail": "subscribers deletion queued", "count": len(ids)}
+            )
+        delete_subscribers(ids)
+        return Response({"detail": "subscribers deleted", "count": len(ids)})
+
     @action(detail=False, methods=["post"])
     def delete_from_bounces(self, request):
         bounces_ids = request.data.get("bounces")
         try:
-            Subscriber.objects.filter(
-                bounces__id__in=bounces_ids, client=request.user.client
-            ).delete()
-            return Response({"detail": "subscribers deleted"})
+            return self.delete_subscribers(
+                Subscriber.objects.filter(
+                    bounces__id__in=bounces_ids, client=request.user.client
+                )
+            )
         except Exception as e:
             print(e)
             return HttpResponseBadRequest(str(e))
@@ -645,34 +681,22 @@ class SubscriberViewSet(DynamicPagination, viewsets.ModelViewSet):
     def delete_from_mailermessages(self, request):
         ids = request.data.get("mailermessages")
         try:
-            emails = [
-                m.to_address
-                for m in MailerMessage.objects.filter(
-                    id__in=ids,
-                    app__in=[
-                        str(d.pk)
-                        for d in Dispatch.objects.filter(
-                            campaign__client__user=request.user
-                        )
-                    ],
-                )
-            ]
+            emails = list(
+                MailerMessage.objects.filter(
+                    id__in=ids, dispatch_link__client=request.user.client
+                ).values_list("to_address", flat=True)
+            )
 
-            Subscriber.objects.filter(
-                email__in=emails, client=request.user.client
-            ).delete()
+            response = self.delete_subscribers(
+                Subscriber.objects.filter(email__in=emails, client=request.user.client)
+            )
 
             # delete logs also
             MailerMessage.objects.filter(
-                to_address__in=emails,
-                app__in=[
-                    str(d.pk)
-                    for d in Dispatch.objects.filter(
-                        campaign__client__user=request.user
-                    )
-                ],
+                to_address__in=emails, dispatch_link__client=request.user.client
             ).delete()
-            return Response({"detail": "subscribers deleted"})
+            invalidate_client_counts(request.user.client.pk, MailerMessage)
+            return response
         except Exception as e:
             print(e)
             return HttpResponseBadRequest(str(e))
@@ -681,14 +705,15 @@ class SubscriberViewSet(DynamicPagination, viewsets.ModelViewSet):
     def delete_many(self, request):
         ids = request.data.get("ids")
         try:
-            Subscriber.objects.filter(id__in=ids, client=request.user.client).delete()
-            return Response({"detail": "subscribers deleted"})
+            return self.delete_subscribers(
+                Subscriber.objects.filter(id__in=ids, client=request.user.client)
+            )
         except Exception as e:
             print(e)
             return HttpResponseBadRequest(str(e))
 
 
-class CampaignViewSet(DynamicPagination, viewsets.ModelViewSet):
+class CampaignViewSet(QueryPlanMixin, DynamicPagination, viewsets.ModelViewSet):
     """Campaigns CRUD"""
 
     lookup_field = "pk"
@@ -696,6 +721,7 @@ class CampaignViewSet(DynamicPagination, viewsets.ModelViewSet):
     serializer_class = CampaignSerializer
     pagination_class = ResultsSetPagination
     pagination_threshold = 100
+    plan_select_related = ("client", "topic", "template")
 
     def get_permissions(self):
         """Only client users can perform object actions"""
@@ -703,6 +729,24 @@ class CampaignViewSet(DynamicPagination, viewsets.ModelViewSet):
             IsClient(),
         ]
 
+    def get_serializer_class(self):
+        """Lists campaigns without their rendered texts"""
+        if self.action == "list":
+            return CampaignSummarySerializer
+        return CampaignSerializer
+
+    def get_plan_annotations(self):
+        """Datetimes of the last dispatches, read by the serializer"""
+        dispatches = Dispatch.objects.filter(campaign=OuterRef("pk")).order_by("-id")
+        return {
+            "last_dispatch_datetime": Subquery(
+                dispatches.values("started_at")[:1]
+            ),
+            "last_not_test_dispatch_datetime": Subquery(
+                dispatches.filter(test=False).values("started_at")[:1]
+            ),
+        }
+
     def get_queryset(self):
         """Retrieves only client's campaigns"""
         qs = self.get_for_client()
@@ -767,7 +811,12 @@ class CampaignViewSet(DynamicPagination, viewsets.ModelViewSet):
     @action(detail=True, methods=["get"])
     def dispatches(self, request, pk=None):
         campaign = self.get_object()
-        data = DispatchSerializer(campaign.dispatch_set, many=True)
+        data = DispatchSummarySerializer(
+            campaign.dispatch_set.select_related("campaign", "stats").prefetch_related(
+                "lists"
+            ),
+            many=True,
+        )
         return Response(data.data)
 
     @action(detail=True, methods=["post"])
@@ -792,12 +841,9 @@ class CampaignViewSet(DynamicPagination, viewsets.ModelViewSet):
         else:
             try:
                 lists = request.data.get("lists")
-                tot = sum(
-                    [
-                        SubscriberList.objects.get(id=l).subscriber_set.count()
-                        for l in lists
-                    ]
-                )
+                tot = Subscriber.lists.through.objects.filter(
+                    subscriberlist_id__in=lists
+                ).count()
                 if tot > settings.TEST_EMAIL_MAX_NUM:
                     return HttpResponseBadRequest(
                         "the max number of allowed e-mails is 50, you tried to send %d"
@@ -872,10 +918,62 @@ class DispatchViewSet(DynamicPagination, viewsets.ReadOnlyModelViewSet):
             qs = qs.filter(started_at__gte=datetime.strptime(date_from, "%Y-%m-%d"))
         if date_to is not None:
             qs = qs.filter(started_at__lte=datetime.strptime(date_to, "%Y-%m-%d"))
+        qs = qs.select_related("campaign").prefetch_related("lists")
+        if self.action == "retrieve":
+            qs = qs.prefetch_related(
+                Prefetch(
+                    "trackings",
+                    queryset=Tracking.objects.select_related("subscriber"),
+                ),
+                Prefetch(
+                    "bounces",
+                    queryset=FailedEmail.objects.select_related(
+                        "subscriber", "dispatch__campaign"
+                    ),
+                ),
+            )
         return qs
 
+    def get_serializer_class(self):
+        """Lists only counters and rates, events have their own actions"""
+        if self.action == "retrieve":
+            return DispatchSerializer
+        return DispatchSummarySerializer
+
     def get_for_client(self):
-        return Dispatch.objects.filter(campaign__client__user__id=self.request.user.id)
+        return Dispatch.objects.filter(
+            campaign__client__user__id=self.request.user.id
+        ).select_related("stats")
+
+    def paginate_events(self, queryset, serializer_class):
+        paginator = EventsCursorPagination()
+        page = paginator.paginate_queryset(queryset, self.request, view=self)
+        serializer = serializer_class(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(detail=True, methods=["get"])
+    def trackings(self, request, pk=None):
+        """Open and click events, cursor paginated"""
+        dispatch = self.get_object()
+        qs = Tracking.objects.filter(dispatch=dispatch).select_related("subscriber")
+        tracking_type = request.query_params.get("type", None)
+        if tracking_type is not None:
+            types = [str(x[0]) for x in Tracking.TYPE_CHOICES]
+            if tracking_type not in types:
+                raise ValidationError(
+                    detail={"detail": "type must be one of %s" % ", ".join(types)}
+                )
+            qs = qs.filter(type=tracking_type)
+        return self.paginate_events(qs, TrackingSerializer)
+
+    @action(detail=True, methods=["get"])
+    def bounces(self, request, pk=None):
+        """Bounces, cursor paginated"""
+        dispatch = self.get_object()
+        qs = FailedEmail.objects.filter(dispatch=dispatch).select_related(
+            "subscriber", "dispatch__campaign"
+        )
+        return self.paginate_events(qs, FailedEmailSerializer)
 
 
 class FailedEmailApiView(View):
@@ -916,6 +1014,8 @@ class FailedEmailApiView(View):
                 subscriber = Subscriber.objects.filter(client=client, email=email).first()
 
                 try:
+                    if dispatch:
+                        DispatchStats.ensure([dispatch.pk])
                     failed_email = FailedEmail(
                         datetime=dt,
                         client=client,
@@ -926,7 +1026,10 @@ class FailedEmailApiView(View):
                         message=message,
                         email_id=email_id,
                     )
-                    failed_email.save()
+                    with transaction.atomic():
+                        failed_email.save()
+                        if dispatch:
+                            DispatchStats.increment(dispatch.pk, bounces=1)
                 except Exception as e:
                     return HttpResponseBadRequest("%s" % str(e))
             # force text plain because on remote server it sends probably
@@ -981,48 +1084,15 @@ class StatsApiView(APIView):
     def get(self, request):
         if not request.user.is_authenticated:
             return Response({"description": "not authenticated"}, status=401)
+        etag, response = client_stats(
+            request.user.id, lambda: dashboard_stats(request.user)
+        )
+        if request.META.get("HTTP_IF_NONE_MATCH", None) == etag:
+            response = Response(status=304)
         else:
-            today = date.today()
-            last_month = today - relativedelta(months=1)
-            tot_subscribers = Subscriber.objects.filter(
-                client__user=request.user
-            ).count()
-            last_month_subscribers = Subscriber.objects.filter(
-                client__user=request.user, subscription_datetime__gte=last_month
-            ).count()
-            last_month_unsubscriptions = Unsubscription.objects.filter(
-                client__user=request.user, datetime__gte=last_month
-            ).count()
-            last_dispatch = Dispatch.objects.filter(
-                campaign__client__user=request.user, test=False
-            ).last()
-            next_planning = Planning.objects.filter(
-                campaign__client__user=request.user, schedule__gte=datetime.now()
-            ).first()
-            tot_bounces = FailedEmail.objects.filter(client__user=request.user).count()
-            tot_dispatching = MailerMessage.objects.filter(
-                app__in=[
-                    str(d.pk)
-                    for d in Dispatch.objects.filter(
-                        campaign__client__user=self.request.user, sent=False
-                    )
-                ]
-            ).count()
-
-            response = {
-                "subscribers": tot_subscribers,
-                "bounces": tot_bounces,
-                "dispatching": tot_dispatching,
-                "lastMonthUnsubscriptions": last_month_unsubscriptions,
-                "lastMonthSubscribers": last_month_subscribers,
-                "lastDispatch": DispatchSerializer(last_dispatch).data
-                if last_dispatch
-                else None,
-                "nextPlanning": PlanningSerializer(next_planning).data
-                if next_planning
-                else None,
-            }
-        return Response(response)
+            response = Response(response)
+        response["ETag"] = etag
+        return response
 
 
 class MailerMessageViewSet(
@@ -1036,6 +1106,7 @@ class MailerMessageViewSet(
     queryset = MailerMessage.objects.all()
     serializer_class = MailerMessageSerializer
     pagination_class = ResultsSetPagination
+    keyset_pagination_class = KeysetPagination
     pagination_threshold = 8000
 
     def get_permissions(self):
@@ -1062,12 +1133,7 @@ class MailerMessageViewSet(
 
     def get_for_client(self):
         return MailerMessage.objects.filter(
-            app__in=[
-                str(d.pk)
-                for d in Dispatch.objects.filter(
-                    campaign__client__user=self.request.user
-                )
-            ]
+            dispatch_link__client__user=self.request.user
         )
 
     @action(detail=False, methods=["get"])
@@ -1081,29 +1147,37 @@ class SubscriptionsStatsApiView(APIView):
         if not request.user.is_authenticated:
             return Response({"description": "not authenticated"}, status=401)
 
-        sub_data = (
-            Subscriber.objects.filter(client__user=request.user)
-            .values("subscription_datetime__date")
-            .exclude(subscription_datetime__date__isnull=True)
-            .order_by("subscription_datetime__date")
-            .annotate(cnt=Count("subscription_datetime__date"))
-        )
-        unsub_data = (
-            Unsubscription.objects.filter(client__user=request.user)
-            .values("datetime__date")
-            .exclude(datetime__date__isnull=True)
-            .order_by("datetime__date")
-            .annotate(cnt=Count("datetime__date"))
-        )
+        date_from = request.GET.get("date_from", None)
+        date_to = request.GET.get("date_to", None)
+        qs = DailyStats.objects.filter(client__user=request.user)
+        try:
+            if date_from is not None:
+                qs = qs.filter(date__gte=datetime.strptime(date_from, "%Y-%m-%d"))
+            if date_to is not None:
+                qs = qs.filter(date__lte=datetime.strptime(date_to, "%Y-%m-%d"))
+        except ValueError:
+            return HttpResponseBadRequest("dates must be in the YYYY-MM-DD format")
+        daily = list(qs.order_by("date"))
 
         return JsonResponse(
             {
                 "subscriptions_stats": SubscribtionsStatsSerializer(
-                    sub_data, many=True
+                    [
+                        {"subscription_datetime__date": x.date, "cnt": x.subscriptions}
+                        for x in daily
+                        if x.subscriptions
+                    ],
+                    many=True,
                 ).data,
                 "unsubscriptions_stats": UnsubscriptionStatsSerializer(
-                    unsub_data, many=True
+                    [
+                        {"datetime__date": x.date, "cnt": x.unsubscriptions}
+                        for x in daily
+                        if x.unsubscriptions
+                    ],
+                    many=True,
                 ).data,
+                "daily_stats": DailyStatsSerializer(daily, many=True).data,
             }
         )
 
@@ -1114,18 +1188,24 @@ class DispatchStatsApiView(APIView):
             return Response({"description": "not authenticated"}, status=401)
 
         ids = request.GET.get("ids", "").split("-")
-        dispatches = Dispatch.objects.filter(
-            campaign__client__user=request.user, campaign__id__in=ids, test=False
+        dispatches = (
+            Dispatch.objects.filter(
+                campaign__client__user=request.user, campaign__id__in=ids, test=False
+            )
+            .select_related("campaign", "stats")
+            .prefetch_related("lists")
         )
 
         return JsonResponse(
             {
-                "dispatches": DispatchSerializer(dispatches, many=True).data,
+                "dispatches": DispatchSummarySerializer(dispatches, many=True).data,
             }
         )
 
 
-class SubscriptionFormViewSet(DynamicPagination, viewsets.ModelViewSet):
+class SubscriptionFormViewSet(
+    QueryPlanMixin, DynamicPagination, viewsets.ModelViewSet
+):
     """SubscriberList CRUD"""
 
     lookup_field = "pk"
@@ -1133,6 +1213,7 @@ class SubscriptionFormViewSet(DynamicPagination, viewsets.ModelViewSet):
     serializer_class = SubscriptionFormSerializer
     pagination_class = ResultsSetPagination
     pagination_threshold = 10000
+    plan_prefetch_related = ("lists",)
 
     def get_permissions(self):
         """Only client users can perform object actions"""